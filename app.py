@@ -1,9 +1,10 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory, Response, stream_with_context
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from pymongo import MongoClient
-from bson import ObjectId
+from pymongo import MongoClient, UpdateOne, ReturnDocument
+from pymongo.errors import OperationFailure, PyMongoError, DuplicateKeyError
+from bson import ObjectId, Binary
 from flask_wtf.csrf import CSRFProtect
 from flask_talisman import Talisman
 from flask_limiter import Limiter
@@ -12,6 +13,7 @@ from urllib.parse import urlparse
 import re
 import os
 import json
+import csv
 import requests
 import time
 from urllib.parse import urljoin
@@ -22,20 +24,195 @@ import fitz # PyMuPDF
 import pytesseract
 from PIL import Image
 import threading
+import queue
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import hashlib
+import hmac
+import bisect
+import statistics
+import socket
+import sqlite3
+import tempfile
+import shutil
+from collections import OrderedDict
+from contextlib import contextmanager
+try:
+    import fcntl  # leader election between worker processes (POSIX)
+except ImportError:
+    fcntl = None
+import click
 #################################################
 from langchain_ollama import OllamaLLM
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_community.embeddings import OllamaEmbeddings
+from langchain_core.embeddings import Embeddings
 import faiss  # For FAISS (vector search)
 import numpy as np # For Data handling
+# Side-effect-free helpers (chunking, BM25/RRF, abbreviations, response cache, section structuring), unit tested on their own
+from rag_helpers import (
+    estimate_tokens, PASSAGE_MAX_TOKENS, split_into_passages, bm25_rank, BM25Index, RRF_K, rrf_fuse,
+    AbbreviationMatcher, ResponseCache, StreamingSectionParser, split_sections_by_rules, text_hash, summarize_section_changes,
+)
 import os
 import datetime
 import re
 
+OLLAMA_BASE_URL = os.environ.get('OLLAMA_BASE_URL', 'http://localhost:11434').rstrip('/')
+# How long Ollama keeps a model loaded after its last request: -1 = until Ollama restarts, or a duration like "30m"
+OLLAMA_KEEP_ALIVE = os.environ.get('OLLAMA_KEEP_ALIVE', '-1')
+OLLAMA_KEEP_ALIVE = int(OLLAMA_KEEP_ALIVE) if re.fullmatch(r'-?\d+', OLLAMA_KEEP_ALIVE) else OLLAMA_KEEP_ALIVE
+# Seconds a health check (reachable + loaded models) is reused before asking Ollama again
+OLLAMA_HEALTH_TTL = float(os.environ.get('OLLAMA_HEALTH_TTL', '10'))
+# Load the models in the background when a worker serves its first request
+OLLAMA_WARMUP = os.environ.get('OLLAMA_WARMUP', '1') == '1'
+OLLAMA_WARMUP_TIMEOUT = float(os.environ.get('OLLAMA_WARMUP_TIMEOUT', '300'))
+# /api/embeddings takes one text per request: embed_documents() keeps this many in flight at once
+# (Ollama serves them in parallel up to its OLLAMA_NUM_PARALLEL)
+OLLAMA_EMBED_CONCURRENCY = int(os.environ.get('OLLAMA_EMBED_CONCURRENCY', '4'))
+
 # Declare chosen models
-query_model = OllamaLLM(model="llama3.2")
-embedding_model = OllamaEmbeddings(model = "nomic-embed-text")
+CHAT_MODEL_NAME = "llama3.2"
+STRUCTURING_MODEL_NAME = "llama3"
+EMBEDDING_MODEL_NAME = "nomic-embed-text"
+
+# One pooled, keep-alive session for every direct call to Ollama (embeddings, structuring, titling, health checks)
+ollama_session = requests.Session()
+ollama_adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=16)
+ollama_session.mount('http://', ollama_adapter)
+ollama_session.mount('https://', ollama_adapter)
+
+def model_tag(name):
+    return name if ":" in name else f"{name}:latest"
+
+def ollama_post(path, payload, **kwargs):
+    """POST to Ollama over the shared session; every request renews the model's keep_alive."""
+    return ollama_session.post(f"{OLLAMA_BASE_URL}{path}", json={"keep_alive": OLLAMA_KEEP_ALIVE, **payload}, **kwargs)
+
+class OllamaHealth:
+    """
+    Whether Ollama is reachable and which models it has loaded (GET /api/ps), reused for OLLAMA_HEALTH_TTL seconds.
+    One caller at a time probes, outside the lock; the others carry on with the last known state meanwhile.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.up = False
+        self.loaded = set()
+        self.checked_at = 0.0
+        self.refreshing = False  # a probe is in flight
+        self.first_check = threading.Event()  # set once any probe has finished
+
+    def check(self, force=False):
+        with self.lock:
+            probe = force or (not self.refreshing and time.time() - self.checked_at >= self.ttl)
+            if probe:
+                self.refreshing = True
+        if not probe:
+            self.first_check.wait(5)  # nothing known yet: wait for the probe in flight rather than report "down"
+            return self.up
+        up, loaded = False, set()
+        try:
+            response = ollama_session.get(f"{OLLAMA_BASE_URL}/api/ps", timeout=3)
+            response.raise_for_status()
+            loaded = {model_tag(m["name"]) for m in response.json().get("models", [])}
+            up = True
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            pass
+        finally:
+            with self.lock:
+                self.up, self.loaded = up, loaded
+                self.checked_at = time.time()
+                self.refreshing = False
+            self.first_check.set()
+        return up
+
+    def is_loaded(self, model):
+        self.check()
+        return model_tag(model) in self.loaded
+
+    def mark_loaded(self, model):
+        with self.lock:
+            self.up = True
+            self.loaded.add(model_tag(model))
+
+    def invalidate(self):
+        with self.lock:
+            self.checked_at = 0.0
+
+    def stats(self):
+        up = self.check()
+        return {"up": up, "base_url": OLLAMA_BASE_URL, "loaded": sorted(self.loaded), "keep_alive": OLLAMA_KEEP_ALIVE}
+
+ollama_health = OllamaHealth(OLLAMA_HEALTH_TTL)
+
+def is_ollama_running():
+    return ollama_health.check()
+
+@contextmanager
+def ollama_call(model, endpoint):
+    """Time one Ollama request into rag_ollama_request_seconds: cold if the model was not loaded when it started."""
+    state = "warm" if ollama_health.is_loaded(model) else "cold"
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ollama_health.invalidate()  # look again instead of trusting a stale "up"
+        raise
+    ollama_seconds.observe(time.perf_counter() - started, model_tag(model), endpoint, state)
+    ollama_health.mark_loaded(model)
+
+class OllamaEmbedder(Embeddings):
+    """
+    Embeddings over the shared session. Same endpoint (/api/embeddings) and instruction prefixes as
+    langchain_community's OllamaEmbeddings, so the vectors match the ones already stored. The batch endpoint
+    (/api/embed) would take a whole list in one request, but returns normalized vectors, which would not
+    match them; embed_documents() runs OLLAMA_EMBED_CONCURRENCY single requests in parallel instead.
+    """
+
+    def __init__(self, model, document_prefix="passage: ", query_prefix="query: "):
+        self.model = model
+        self.document_prefix = document_prefix
+        self.query_prefix = query_prefix
+        self.executor = ThreadPoolExecutor(max_workers=OLLAMA_EMBED_CONCURRENCY, thread_name_prefix='embed')
+
+    def embed(self, text):
+        with ollama_call(self.model, "embeddings"):
+            response = ollama_post("/api/embeddings", {"model": self.model, "prompt": text}, timeout=120)
+            response.raise_for_status()
+            return response.json()["embedding"]
+
+    def embed_documents(self, texts):
+        texts = [self.document_prefix + text for text in texts]
+        if len(texts) <= 1:
+            return [self.embed(text) for text in texts]
+        return list(self.executor.map(self.embed, texts))  # in input order
+
+    def embed_query(self, text):
+        return self.embed(self.query_prefix + text)
+
+query_model = OllamaLLM(model=CHAT_MODEL_NAME, base_url=OLLAMA_BASE_URL, keep_alive=OLLAMA_KEEP_ALIVE)
+embedding_model = OllamaEmbedder(EMBEDDING_MODEL_NAME)
+
+def warm_up_ollama():
+    """Load the chat, structuring and embedding models now, so the first real request does not pay for it."""
+    if not ollama_health.check(force=True):
+        print(f"⚠️ Ollama is not reachable at {OLLAMA_BASE_URL}; skipping model warm-up")
+        return
+    for model, path, payload in ((CHAT_MODEL_NAME, "/api/generate", {}),
+                                 (STRUCTURING_MODEL_NAME, "/api/generate", {}),
+                                 (EMBEDDING_MODEL_NAME, "/api/embeddings", {"prompt": ""})):
+        if ollama_health.is_loaded(model):
+            continue  # another worker (or an earlier run) already loaded it
+        try:
+            started = time.perf_counter()
+            with ollama_call(model, "load"):
+                # No prompt: Ollama only loads the model and applies keep_alive
+                ollama_post(path, {"model": model, **payload}, timeout=OLLAMA_WARMUP_TIMEOUT).raise_for_status()
+            print(f"🔥 Loaded {model} in {time.perf_counter() - started:.1f}s (keep_alive={OLLAMA_KEEP_ALIVE})")
+        except Exception as e:
+            print(f"⚠️ Could not warm up {model}: {e}")
 
 # Declare prompt format structure with a template
 promptTemplate = """
@@ -50,8 +227,34 @@ Question: {question}
 
 Answer:
 """
-# Declare the number of nearest neighbors to retrieve
-numNearestNeighbors = 1
+# Declare the number of nearest neighbors to retrieve (retrieval units are small passages, see PASSAGE_MAX_TOKENS)
+numNearestNeighbors = int(os.environ.get('RAG_TOP_K', '3'))
+
+# RAG collections that feed the retrieval index. Scraped laws are retrieved through their
+# passages (token-bounded chunks of each section), not as whole sections. Abbreviations are not
+# retrieved: they are expanded in the question and context by AbbreviationMatcher instead.
+RAG_COLLECTIONS = ["data", "passages"]
+
+# Hybrid retrieval: candidates taken from each retriever before reciprocal rank fusion (RRF_K is in rag_helpers)
+HYBRID_VECTOR_K = int(os.environ.get('HYBRID_VECTOR_K', '10'))
+HYBRID_LEXICAL_K = int(os.environ.get('HYBRID_LEXICAL_K', '10'))
+
+# Where published generations of the retrieval index live; every worker process maps the current one read-only
+VECTOR_INDEX_DIR = os.environ.get('VECTOR_INDEX_DIR', os.path.join(os.path.dirname(__file__), 'instance', 'rag_index'))
+# Leader: publish pending changes at most this often. Followers: check for a newer generation this often.
+INDEX_PUBLISH_INTERVAL = float(os.environ.get('INDEX_PUBLISH_INTERVAL', '5'))
+INDEX_REFRESH_INTERVAL = float(os.environ.get('INDEX_REFRESH_INTERVAL', '5'))
+INDEX_KEEP_GENERATIONS = int(os.environ.get('INDEX_KEEP_GENERATIONS', '3'))
+
+# How often (seconds) to poll the RAG collections for changes when change streams are unavailable (standalone mongod)
+CORPUS_POLL_INTERVAL = float(os.environ.get('CORPUS_POLL_INTERVAL', '30'))
+
+# Only the fields retrieval needs (no full_text)
+CORPUS_PROJECTION = {
+    "term": 1, "explanation": 1, "feature_name": 1, "feature_description": 1, "embedding": 1,
+    "law_name": 1, "source_url": 1, "section_title": 1, "text": 1, "updated_at": 1,
+    "content_sections.title": 1, "content_sections.content": 1, "content_sections.embeddings": 1,
+}
 
 # Connect the prompt and LLM model by "chaining" them together
 prompt = ChatPromptTemplate.from_template(promptTemplate)
@@ -66,77 +269,806 @@ def get_embeddings(documents):
     embeddings = np.array(embeddings)
     return embeddings
 
+# Vectors are stored in Mongo as packed binary (BSON BinData) rather than arrays of doubles: 4x smaller as float32,
+# 8x as float16, and read back with np.frombuffer instead of converting element by element.
+VECTOR_STORAGE_DTYPE = os.environ.get('VECTOR_STORAGE_DTYPE', 'float32')
+VECTOR_SUBTYPES = {"float32": 0x80, "float16": 0x81}  # user-defined BinData subtypes record the element type
+
+def pack_vector(vector, dtype=None):
+    dtype = dtype or VECTOR_STORAGE_DTYPE
+    return Binary(np.asarray(vector, dtype=dtype).tobytes(), VECTOR_SUBTYPES[dtype])
+
+def unpack_vector(value):
+    """Stored vector (packed binary, or a legacy list of doubles) as a float32 array; None when there is none."""
+    if value is None:
+        return None
+    if isinstance(value, Binary):
+        dtype = "float16" if value.subtype == VECTOR_SUBTYPES["float16"] else "float32"
+        vector = np.frombuffer(value, dtype=dtype)
+        return vector if dtype == "float32" else vector.astype("float32")
+    return np.asarray(value, dtype="float32") if len(value) else None
+
+class QueryEmbeddingCache:
+    """
+    Bounded LRU/TTL cache of query embeddings keyed on (embedding model, normalized question text).
+    Optionally backed by a SQLite file so warm entries survive restarts.
+    """
+
+    def __init__(self, max_entries, ttl, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (created_at, vector)
+        self.hits = 0
+        self.misses = 0
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with self._connect() as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS query_embeddings (key TEXT PRIMARY KEY, created_at REAL, vector BLOB)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    @staticmethod
+    def normalize(text):
+        return re.sub(r"\s+", " ", text or "").strip().lower()
+
+    def _key(self, text):
+        return f"{EMBEDDING_MODEL_NAME}:{self.normalize(text)}"
+
+    def _remember(self, key, created_at, vector):
+        self.entries[key] = (created_at, vector)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, text):
+        key = self._key(text)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and now - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        if self.path:
+            with self._connect() as conn:
+                row = conn.execute("SELECT created_at, vector FROM query_embeddings WHERE key = ?", (key,)).fetchone()
+            if row and now - row[0] < self.ttl:
+                vector = np.frombuffer(row[1], dtype="float32")
+                with self.lock:
+                    self._remember(key, row[0], vector)
+                    self.hits += 1
+                return vector
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, text, vector):
+        key = self._key(text)
+        now = time.time()
+        vector = np.asarray(vector, dtype="float32")
+        with self.lock:
+            self._remember(key, now, vector)
+        if self.path:
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?)", (key, now, vector.tobytes()))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0, "size": len(self.entries)}
+
+query_embedding_cache = QueryEmbeddingCache(
+    max_entries=int(os.environ.get('QUERY_EMBEDDING_CACHE_SIZE', '2048')),
+    ttl=float(os.environ.get('QUERY_EMBEDDING_CACHE_TTL', '86400')),
+    path=os.environ.get('QUERY_EMBEDDING_CACHE_PATH') or None,
+)
+
+# Embed a single user query, reusing the cached vector for repeated questions.
+def get_query_embedding(text):
+    vector = query_embedding_cache.get(text)
+    if vector is None:
+        vector = np.asarray(get_embeddings([text])[0], dtype="float32")
+        query_embedding_cache.put(text, vector)
+    return vector.reshape(1, -1)
+
+# Vector index backend; "auto" picks one from the corpus size when the index is (re)built
+VECTOR_INDEX_BACKEND = os.environ.get('VECTOR_INDEX_BACKEND', 'auto')
+ANN_FLAT_MAX_VECTORS = int(os.environ.get('ANN_FLAT_MAX_VECTORS', '20000'))    # exact search below this
+ANN_HNSW_MAX_VECTORS = int(os.environ.get('ANN_HNSW_MAX_VECTORS', '200000'))   # HNSW up to this, IVF with int8 codes beyond
+# Search-time accuracy/speed knobs: IVF lists probed, HNSW candidate list size
+VECTOR_NPROBE = int(os.environ.get('VECTOR_NPROBE', '16'))
+HNSW_EF_SEARCH = int(os.environ.get('HNSW_EF_SEARCH', '64'))
+# Backends that cannot remove vectors hide deleted ones instead; past this fraction of the index it is compacted
+TOMBSTONE_COMPACT_RATIO = float(os.environ.get('TOMBSTONE_COMPACT_RATIO', '0.2'))
+
+# backend -> (faiss index_factory string, supports remove_ids, needs training)
+INDEX_BACKENDS = {
+    "flat": ("IDMap2,Flat", True, False),
+    "hnsw": ("IDMap2,HNSW32", False, False),
+    "hnswsq8": ("IDMap2,HNSW32,SQ8", False, True),  # int8 scalar-quantized vectors, 4x smaller
+    "ivf": ("IVF{nlist},Flat", True, True),
+    "ivfsq8": ("IVF{nlist},SQ8", True, True),
+    "ivfpq": ("IVF{nlist},PQ{m}", True, True),      # product quantization, ~32x smaller
+}
+
+def choose_index_backend(n_vectors):
+    if VECTOR_INDEX_BACKEND != "auto":
+        return VECTOR_INDEX_BACKEND
+    if n_vectors < ANN_FLAT_MAX_VECTORS:
+        return "flat"
+    if n_vectors < ANN_HNSW_MAX_VECTORS:
+        return "hnsw"
+    return "ivfsq8"
+
 # Initialize FAISS index and add embeddings to it.
-def initialize_faiss_index(document_embeddings):
-    embedding_dim = document_embeddings.shape[1]  # Dimension of the embeddings
-    faiss_index = faiss.IndexFlatL2(embedding_dim)  # Use L2 distance for similarity
-    faiss_index.add(document_embeddings)  # Add document embeddings to FAISS index
-    return faiss_index
-
-# Function to retrieve the most similar (nearest) documents using FAISS and MongoDB
-def retrieve_top_k_documents(userInputEmbedding, infoDatabase, k):
-    if len(infoDatabase) != 0:
-        # extract all embeddings from infoDatabase into an array and convert to numpy array
-        infoDatabaseEmbeddings = []
-        corrospondingData = []
-
-        # Loop over keys that have embeddings
-        for key in ["Abbreviations", "data", "webscrapped_data"]:
-            value_list = infoDatabase.get(key, [])
-
-            if key == "webscrapped_data":
-                # Each item is a dict containing 'content_sections' (which is a list)
-                for item in value_list:
-                    content_sections = item.get("content_sections", [])
-                    for section in content_sections:  # iterate over list directly
-                        itemTitle = section.get("title", [])
-                        itemContent = section.get("content", [])
-                        itemEmbedding = section.get("embeddings", [])
-                        infoDatabaseEmbeddings.append(itemEmbedding)
-                        corrospondingData.append({"mainPoint" : itemTitle, "elabContent" : itemContent, "contentEmbedding" : itemEmbedding})
-            else:
-                # Abbreviations and data
-                for item in value_list:
-                    itemTerm = item.get("term", [])
-                    itemExplanation = item.get("explanation", [])
-                    itemEmbedding = item.get("embedding", [])
-                    infoDatabaseEmbeddings.append(itemEmbedding)
-                    corrospondingData.append({"mainPoint" : itemTerm, "elabContent" : itemExplanation, "contentEmbedding" : itemEmbedding})
-
-        infoDatabaseEmbeddings = np.array(infoDatabaseEmbeddings)
-
-        # Initialize FAISS index
-        faiss_index = initialize_faiss_index(infoDatabaseEmbeddings)
-
-        # Perform similarity search using FAISS (on stored embeddings from database)
-        distances, indices = faiss_index.search(userInputEmbedding, k)
-
-        # Retrieve the actual vectors of the nearest neighbors
-        nearest_vectors = np.array(infoDatabaseEmbeddings)[indices[0]]
-
-        # Retrieve the corresponding documents
-        mainPoint = [corrospondingData[i]["mainPoint"] for i in indices[0]]
-        elabContent = [corrospondingData[i]["elabContent"] for i in indices[0]]
-
-        # Combine results for easier handling
-        knnResults = []
-        for i in range(k):
-            knnResults.append({
-                "point": mainPoint[i],
-                "document": elabContent[i],
-                "vector": nearest_vectors[i].tolist(),  # Convert to list for JSON compatibility
-                "distance": distances[0][i],
-                "index": indices[0][i]
-            })
+def initialize_faiss_index(embedding_dim, backend="flat", n_vectors=0):
+    # Use L2 distance for similarity; every backend takes our own stable ids (IDMap2 or IVF's native ids)
+    nlist = max(1, min(int(4 * np.sqrt(max(n_vectors, 1))), n_vectors // 39))  # >= 39 training points per list
+    m = next(m for m in range(max(1, embedding_dim // 8), 0, -1) if embedding_dim % m == 0)
+    index = faiss.index_factory(embedding_dim, INDEX_BACKENDS[backend][0].format(nlist=nlist, m=m))
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)  # reconstruct() and remove_ids() by id
+    tune_faiss_index(index)
+    return index
+
+def tune_faiss_index(index, nprobe=None, ef_search=None):
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe or VECTOR_NPROBE, ivf.nlist)
+    base = index
+    while isinstance(base, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        base = faiss.downcast_index(base.index)
+    if hasattr(base, "hnsw"):
+        base.hnsw.efSearch = ef_search or HNSW_EF_SEARCH
+
+def write_mappable_index(index, path):
+    """
+    write_index(), with IVF inverted lists moved to an index.ivfdata file next to `path` (OnDiskInvertedLists):
+    read_index() cannot map IVF lists stored inline, but maps an ivfdata file. Modifies `index`, so pass a copy.
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        invlists = faiss.OnDiskInvertedLists(ivf.nlist, ivf.code_size, os.path.join(os.path.dirname(path), "index.ivfdata"))
+        lists = faiss.InvertedListsPtrVector()
+        lists.push_back(ivf.invlists)
+        invlists.merge_from_multiple(lists.data(), lists.size())
+        ivf.replace_invlists(invlists, True)
+        invlists.this.disown()
+    faiss.write_index(index, path)
+
+def load_ivf_lists(index):
+    """Copy mapped IVF lists into memory, so the index can be added to and removed from again."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is None:
+        return index
+    mapped, in_memory = ivf.invlists, faiss.ArrayInvertedLists(ivf.nlist, ivf.code_size)
+    for list_no in range(ivf.nlist):
+        size = mapped.list_size(list_no)
+        if size:
+            in_memory.add_entries(list_no, size, mapped.get_ids(list_no), mapped.get_codes(list_no))
+    ivf.replace_invlists(in_memory, True)
+    in_memory.this.disown()
+    return index
+
+def train_faiss_index(sample, backend=None):
+    """New index for vectors like `sample` (n, d), trained on them when the backend needs it; falls back to flat."""
+    backend = backend or choose_index_backend(len(sample))
+    index = initialize_faiss_index(sample.shape[1], backend, len(sample))
+    if not index.is_trained:
+        try:
+            index.train(sample)
+        except RuntimeError as e:
+            print(f"⚠️ Could not train a {backend} index on {len(sample)} vectors, using flat: {e}")
+            return initialize_faiss_index(sample.shape[1]), "flat"
+    return index, backend
+
+# Flatten a RAG document into (key, mainPoint, elabContent, embedding) entries.
+# Scraped laws contribute one entry per content section, everything else one entry per document.
+def iter_document_entries(collection_name, item):
+    doc_id = str(item.get("_id"))
+    if collection_name == "webscrapped_data":
+        for i, section in enumerate(item.get("content_sections") or []):
+            yield [collection_name, doc_id, i], section.get("title", []), section.get("content", []), unpack_vector(section.get("embeddings"))
+    elif collection_name == "passages":
+        yield [collection_name, doc_id, 0], f"{item.get('law_name', '')}: {item.get('section_title', '')}", item.get("text", []), unpack_vector(item.get("embedding"))
+    else:
+        # Abbreviations use term/explanation, feature data uses feature_name/feature_description
+        itemTerm = item.get("term", item.get("feature_name", []))
+        itemExplanation = item.get("explanation", item.get("feature_description", []))
+        yield [collection_name, doc_id, 0], itemTerm, itemExplanation, unpack_vector(item.get("embedding"))
 
-        return knnResults
-    
-    return None
+def record_text(record):
+    return " ".join(str(part) for part in (record.get("mainPoint"), record.get("elabContent")) if isinstance(part, str))
+
+def map_array(path):
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        return np.load(path)  # empty arrays cannot be mapped
+
+class MappedRecords:
+    """Read-only faiss id -> record table of a published generation: sorted ids and offsets into a JSON blob, all mapped."""
+
+    def __init__(self, directory):
+        self.ids = map_array(os.path.join(directory, "ids.npy"))
+        self.offsets = map_array(os.path.join(directory, "offsets.npy"))
+        path = os.path.join(directory, "records.bin")
+        self.blob = np.memmap(path, dtype=np.uint8, mode="r") if os.path.getsize(path) else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _position(self, faiss_id):
+        i = int(np.searchsorted(self.ids, faiss_id))
+        return i if i < len(self.ids) and self.ids[i] == faiss_id else None
+
+    def _record(self, i):
+        return json.loads(self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes())
+
+    def __contains__(self, faiss_id):
+        return self._position(faiss_id) is not None
+
+    def __getitem__(self, faiss_id):
+        i = self._position(faiss_id)
+        if i is None:
+            raise KeyError(faiss_id)
+        return self._record(i)
+
+    def items(self):
+        for i in range(len(self.ids)):
+            yield int(self.ids[i]), self._record(i)
+
+class MappedBM25:
+    """BM25Index.search() over a published generation's postings, stored as mapped CSR arrays."""
+
+    def __init__(self, directory, meta, ids):
+        with open(os.path.join(directory, "vocab.json"), encoding="utf-8") as f:
+            self.vocab = {term: row for row, term in enumerate(json.load(f))}
+        self.offsets = map_array(os.path.join(directory, "post_offsets.npy"))
+        self.docs = map_array(os.path.join(directory, "post_docs.npy"))      # positions in ids
+        self.tfs = map_array(os.path.join(directory, "post_tf.npy"))
+        self.doc_lengths = map_array(os.path.join(directory, "doc_lengths.npy"))
+        self.ids = ids
+        self.k1, self.b = meta["bm25"]["k1"], meta["bm25"]["b"]
+        self.n, self.total_length = meta["bm25"]["docs"], meta["bm25"]["total_length"]
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def search(self, query, k):
+        if self.n == 0:
+            return []
+        postings = []
+        for term in BM25Index.query_terms(query):
+            row = self.vocab.get(term)
+            if row is None:
+                continue
+            positions = np.asarray(self.docs[self.offsets[row]:self.offsets[row + 1]])
+            tf = np.asarray(self.tfs[self.offsets[row]:self.offsets[row + 1]], dtype="float64")
+            postings.append((positions, tf, np.asarray(self.doc_lengths[positions], dtype="float64")))
+        ranked = bm25_rank(postings, self.n, self.total_length / self.n, self.k1, self.b, k)
+        return [(int(self.ids[position]), score) for position, score in ranked]
+
+class RetrievalIndex:
+    """
+    Long-lived FAISS index over the RAG corpus.
+    One process (the leader, holding leader.lock) builds it, keeps it up to date incrementally and publishes it as
+    immutable generation directories; every other worker process maps the current generation read-only and
+    switches to a newer one when CURRENT moves, so workers share the index through the page cache instead of each
+    holding a copy (except for index types this faiss build cannot map, see load_generation()).
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.RLock()
+        self.index = None     # created once the embedding dimension is known
+        self.backend = "flat"  # key of INDEX_BACKENDS
+        self.tombstones = set()  # deleted faiss ids still in an index that cannot remove them
+        self.records = {}     # faiss id -> {"key": [collection, mongo _id, section], "mainPoint", "elabContent"}
+        self.doc_ids = {}     # "collection/mongo _id" -> [faiss ids]
+        self.next_id = 0
+        self.watermarks = {}  # collection -> newest updated_at already indexed
+        self.lexical = BM25Index()  # kept in step with the vector index, over the same record ids
+        self.ready = False
+        self.role = None         # "leader" (mutable, publishes) or "follower" (mapped, read-only)
+        self.generation = None   # generation currently held
+        self.dirty = False       # leader has changes not yet published
+        self.checked_at = 0.0
+        self.leader_lock = None
+        self.publisher = None
+        self.compacting = False  # a compaction is being built in the background
+        self.publish_lock = threading.Lock()  # one generation written at a time
+        self.version = 0            # bumped by every snapshot()
+        self.published_version = 0  # snapshot version behind the newest generation this process published
+        self.vectors_version = 0    # bumped whenever the FAISS index changes
+        self.published_vectors = None  # (vectors_version, generation) whose index files match the FAISS index
+
+    def __len__(self):
+        return len(self.records)
+
+    def _add_entries(self, entries):
+        vectors, ids = [], []
+        for key, mainPoint, elabContent, embedding in entries:
+            faiss_id = self.next_id
+            self.next_id += 1
+            record = {"key": key, "mainPoint": mainPoint, "elabContent": elabContent}
+            self.records[faiss_id] = record
+            self.doc_ids.setdefault(f"{key[0]}/{key[1]}", []).append(faiss_id)
+            # Lexical matching works even before a vector exists
+            self.lexical.add(faiss_id, record_text(record))
+            if embedding is None or len(embedding) == 0:
+                continue  # not embedded yet
+            vector = np.asarray(embedding, dtype="float32")
+            if self.index is None:
+                self.index, self.backend = initialize_faiss_index(vector.shape[0]), "flat"
+            if vector.shape[0] != self.index.d:
+                print(f"⚠️ Skipping vector for {key}: embedding dimension {vector.shape[0]} != index dimension {self.index.d}")
+                continue
+            vectors.append(vector)
+            ids.append(faiss_id)
+        if vectors:
+            self.index.add_with_ids(np.vstack(vectors), np.asarray(ids, dtype="int64"))
+            self.vectors_version += 1
+        return len(ids)
+
+    def remove_document(self, collection_name, doc_id):
+        with self.lock:
+            ids = self.doc_ids.pop(f"{collection_name}/{doc_id}", [])
+            for faiss_id in ids:
+                record = self.records.pop(faiss_id, None)
+                if record is not None:
+                    self.lexical.remove(faiss_id, record_text(record))
+            if ids and self.index is not None:
+                if INDEX_BACKENDS[self.backend][1]:
+                    self.index.remove_ids(np.asarray(ids, dtype="int64"))
+                    self.vectors_version += 1
+                else:
+                    self.tombstones.update(ids)
+                    if not self.compacting and len(self.tombstones) > TOMBSTONE_COMPACT_RATIO * max(self.index.ntotal, 1):
+                        self.compacting = True
+                        threading.Thread(target=self.compact, daemon=True, name="index-compact").start()
+            return len(ids)
+
+    def compact(self):
+        """
+        Re-create a tombstoned index without its deleted vectors. The (slow) build runs outside the lock, so
+        searches carry on against the old index; vectors added meanwhile are copied over before the swap.
+        """
+        try:
+            with self.lock:
+                index, backend, first_new_id = self.index, self.backend, self.next_id
+                ids = faiss.vector_to_array(index.id_map)
+                dead = np.fromiter(self.tombstones, dtype="int64", count=len(self.tombstones))
+                keep = ids[~np.isin(ids, dead)]
+                vectors = index.reconstruct_batch(keep) if len(keep) else None
+            if vectors is None:
+                # Nothing to train on: flat needs no training, and vectors added meanwhile can still go in
+                replacement, backend = initialize_faiss_index(index.d), "flat"
+            else:
+                replacement, backend = train_faiss_index(vectors, backend)
+                replacement.add_with_ids(vectors, keep)
+            with self.lock:
+                if self.index is not index:
+                    return  # rebuilt or reloaded in the meantime
+                ids = faiss.vector_to_array(index.id_map)
+                added = ids[ids >= first_new_id]
+                if len(added):
+                    replacement.add_with_ids(index.reconstruct_batch(added), added)
+                # Ids deleted during the build stay tombstoned
+                self.tombstones -= set(dead.tolist())
+                self.index, self.backend = replacement, backend
+                self.vectors_version += 1
+                self.dirty = True
+            print(f"🧹 Compacted retrieval index to {len(keep)} vectors")
+        except Exception as e:
+            print(f"❌ Could not compact the retrieval index, keeping the current one: {e}")
+        finally:
+            self.compacting = False
+
+    def upsert_documents(self, collection_name, documents, save=True):
+        """Replace the vectors of the given documents (all of their sections) with their current embeddings."""
+        with self.lock:
+            added = 0
+            for item in documents:
+                self.remove_document(collection_name, str(item.get("_id")))
+                added += self._add_entries(iter_document_entries(collection_name, item))
+                updated_at = item.get("updated_at")
+                if isinstance(updated_at, datetime.datetime) and updated_at > self.watermarks.get(collection_name, datetime.datetime.min):
+                    self.watermarks[collection_name] = updated_at
+            if save and documents:
+                self.dirty = True
+            return added
+
+    def rebuild(self, infoDatabase, backend=None):
+        """Build from scratch; the backend (VECTOR_INDEX_BACKEND, or by corpus size) is trained on the whole corpus."""
+        with self.lock:
+            self.index, self.backend, self.tombstones = None, "flat", set()
+            self.vectors_version += 1
+            self.records, self.doc_ids, self.next_id, self.watermarks = {}, {}, 0, {}
+            self.lexical = BM25Index()
+            vectors = [np.asarray(embedding, dtype="float32")
+                       for collection_name in RAG_COLLECTIONS for item in infoDatabase.get(collection_name, [])
+                       for _, _, _, embedding in iter_document_entries(collection_name, item)
+                       if embedding is not None and len(embedding)]
+            if vectors:
+                dim = statistics.mode(len(v) for v in vectors)
+                self.index, self.backend = train_faiss_index(np.vstack([v for v in vectors if len(v) == dim]), backend)
+            for collection_name in RAG_COLLECTIONS:
+                self.upsert_documents(collection_name, infoDatabase.get(collection_name, []), save=False)
+            self.publish(replace=True)
+            print(f"✅ Built {self.backend} retrieval index with {len(self)} records ({self.index.ntotal if self.index is not None else 0} vectors)")
+
+    def current_generation(self):
+        try:
+            with open(os.path.join(self.directory, "CURRENT"), encoding="utf-8") as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def _generation_dir(self, generation):
+        return os.path.join(self.directory, f"gen-{generation:06d}")
+
+    def snapshot(self):
+        """
+        Copy of the state publish() writes, taken under the lock. Kept cheap: BM25 postings are shared copy-on-write,
+        records are copied shallowly, and the FAISS index is only serialized if it changed since the last publish.
+        """
+        with self.lock:
+            self.version += 1
+            postings, doc_lengths, total_length = self.lexical.snapshot()
+            reuse = None
+            if self.index is not None and self.published_vectors is not None and self.published_vectors[0] == self.vectors_version:
+                reuse = self.published_vectors[1]  # that generation's index files hold exactly these vectors
+            state = {
+                "version": self.version,
+                "base": self.generation,
+                "vectors_version": self.vectors_version,
+                "index": faiss.serialize_index(self.index) if self.index is not None and reuse is None else None,
+                "reuse_index": reuse,
+                "records": dict(self.records),
+                "postings": postings,
+                "doc_lengths": doc_lengths,
+                "meta": {
+                    "has_index": self.index is not None,
+                    "backend": self.backend,
+                    "next_id": self.next_id,
+                    "watermarks": {k: v.isoformat() for k, v in self.watermarks.items()},
+                    "tombstones": set(self.tombstones),
+                    "bm25": {"k1": self.lexical.k1, "b": self.lexical.b, "docs": len(doc_lengths), "total_length": total_length},
+                },
+            }
+            self.dirty = False  # changes made from here on are published next time
+        state["meta"]["tombstones"] = sorted(state["meta"]["tombstones"])
+        return state
+
+    def publish(self, replace=False):
+        """
+        Write the index as a new generation directory, then point CURRENT at it (atomic rename and replace).
+        Only snapshot() holds the index lock; the files are written from the copy, so searches carry on meanwhile.
+        If another process (e.g. `flask rebuild-index`) published a generation this one is not based on, nothing is
+        written unless `replace`: the leader adopts that generation and merges its own changes in first (refresh()).
+        """
+        state = self.snapshot()
+        with self.publish_lock:
+            if state["version"] < self.published_version:
+                return  # a newer snapshot was published while this one waited
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = tempfile.mkdtemp(prefix=".publish-", dir=self.directory)
+            try:
+                self._write_generation(tmp, state)
+            except Exception:
+                shutil.rmtree(tmp, ignore_errors=True)
+                self.published_vectors = None  # e.g. the reused generation is gone: serialize next time
+                raise
+            records = state["records"]
+
+            lock_handle = None
+            if fcntl is not None:
+                # Held while choosing the number and moving CURRENT, so a concurrent publisher cannot slip in between
+                lock_handle = open(os.path.join(self.directory, "publish.lock"), "a+")
+                fcntl.flock(lock_handle, fcntl.LOCK_EX)
+            try:
+                current = self.current_generation()
+                if not replace and current is not None and current not in (state["base"], self.generation):
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    self.dirty, self.checked_at = True, 0.0
+                    print(f"🔀 Retrieval index generation {current} was published by another process; adopting it and merging this leader's changes")
+                    return
+                generation = (current or 0) + 1
+                while True:
+                    try:
+                        os.rename(tmp, self._generation_dir(generation))
+                        break
+                    except OSError:
+                        generation += 1  # another process published this number first
+                pointer = os.path.join(self.directory, f"CURRENT.{os.getpid()}.tmp")
+                with open(pointer, "w", encoding="utf-8") as f:
+                    f.write(str(generation))
+                os.replace(pointer, os.path.join(self.directory, "CURRENT"))
+            finally:
+                if lock_handle is not None:
+                    lock_handle.close()
+            self.generation, self.published_version = generation, state["version"]
+            self.published_vectors = (state["vectors_version"], generation)
+
+            # Old generations can go: processes still mapping them keep their (unlinked) files until they move on
+            published = sorted(int(name[4:]) for name in os.listdir(self.directory) if re.fullmatch(r"gen-\d+", name))
+            for old in published[:-INDEX_KEEP_GENERATIONS]:
+                shutil.rmtree(self._generation_dir(old), ignore_errors=True)
+            print(f"📤 Published retrieval index generation {generation} ({len(records)} records)")
+
+    def _write_generation(self, tmp, state):
+        """The files of one generation, from a snapshot() copy."""
+        if state["index"] is not None:
+            write_mappable_index(faiss.deserialize_index(state["index"]), os.path.join(tmp, "index.faiss"))
+        elif state["reuse_index"] is not None:
+            # Vectors unchanged: link the previous generation's index files (never modified in place)
+            source = self._generation_dir(state["reuse_index"])
+            for name in ("index.faiss", "index.ivfdata"):
+                if os.path.exists(os.path.join(source, name)):
+                    try:
+                        os.link(os.path.join(source, name), os.path.join(tmp, name))
+                    except OSError:
+                        shutil.copyfile(os.path.join(source, name), os.path.join(tmp, name))
+            if not os.path.exists(os.path.join(tmp, "index.faiss")):
+                raise FileNotFoundError(f"index.faiss of generation {state['reuse_index']} to reuse")
+        # Record table: sorted ids, offsets into one blob of JSON records
+        records = state["records"]
+        ids = np.array(sorted(records), dtype="int64")
+        blobs = [json.dumps(records[int(faiss_id)], default=str).encode("utf-8") for faiss_id in ids]
+        offsets = np.zeros(len(blobs) + 1, dtype="int64")
+        offsets[1:] = np.cumsum([len(blob) for blob in blobs], dtype="int64")
+        np.save(os.path.join(tmp, "ids.npy"), ids)
+        np.save(os.path.join(tmp, "offsets.npy"), offsets)
+        with open(os.path.join(tmp, "records.bin"), "wb") as f:
+            f.write(b"".join(blobs))
+        # BM25 postings as CSR arrays over positions in ids
+        position = {int(faiss_id): i for i, faiss_id in enumerate(ids)}
+        vocab = sorted(state["postings"])
+        post_offsets, post_docs, post_tf = [0], [], []
+        for term in vocab:
+            for doc_id, tf in sorted(state["postings"][term].items()):
+                post_docs.append(position[doc_id])
+                post_tf.append(tf)
+            post_offsets.append(len(post_docs))
+        np.save(os.path.join(tmp, "post_offsets.npy"), np.asarray(post_offsets, dtype="int64"))
+        np.save(os.path.join(tmp, "post_docs.npy"), np.asarray(post_docs, dtype="int64"))
+        np.save(os.path.join(tmp, "post_tf.npy"), np.asarray(post_tf, dtype="int32"))
+        np.save(os.path.join(tmp, "doc_lengths.npy"), np.asarray([state["doc_lengths"].get(int(i), 0) for i in ids], dtype="int32"))
+        with open(os.path.join(tmp, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(vocab, f)
+        meta = dict(state["meta"], created_at=datetime.datetime.utcnow().isoformat())
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+    def load_generation(self, generation, mapped):
+        """Switch to a published generation: mapped read-only (followers) or as mutable in-memory state (leader)."""
+        directory = self._generation_dir(generation)
+        try:
+            with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+            index = None
+            if meta["has_index"]:
+                path = os.path.join(directory, "index.faiss")
+                if os.path.exists(os.path.join(directory, "index.ivfdata")):
+                    # IVF lists live in index.ivfdata (see write_mappable_index), which faiss always maps
+                    index = faiss.read_index(path, faiss.IO_FLAG_ONDISK_SAME_DIR)
+                    if not mapped:
+                        load_ivf_lists(index)
+                elif mapped:
+                    # Vector data stays in the page cache, shared by every worker
+                    try:
+                        index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0))
+                    except RuntimeError as e:
+                        print(f"⚠️ This faiss build cannot map a {meta['backend']} index, so this worker loads its own copy: {e}")
+                        index = faiss.read_index(path, faiss.IO_FLAG_READ_ONLY)
+                else:
+                    index = faiss.read_index(path)
+                tune_faiss_index(index)
+            records = MappedRecords(directory)
+            lexical = MappedBM25(directory, meta, records.ids) if mapped else None
+        except Exception as e:
+            print(f"⚠️ Could not load retrieval index generation {generation}: {e}")
+            return False
+        with self.lock:
+            self.index = index
+            self.backend = meta["backend"]
+            self.tombstones = set(meta["tombstones"])
+            self.next_id = meta["next_id"]
+            self.watermarks = {k: datetime.datetime.fromisoformat(v) for k, v in meta["watermarks"].items()}
+            if mapped:
+                self.records, self.lexical, self.doc_ids = records, lexical, {}
+            else:
+                self.records, self.doc_ids = dict(records.items()), {}
+                # The inverted index is cheap to rebuild from the stored records
+                self.lexical = BM25Index()
+                for faiss_id, record in self.records.items():
+                    self.doc_ids.setdefault(f"{record['key'][0]}/{record['key'][1]}", []).append(faiss_id)
+                    self.lexical.add(faiss_id, record_text(record))
+            self.generation = generation
+            self.vectors_version += 1
+            self.published_vectors = (self.vectors_version, generation)
+        print(f"✅ {'Mapped' if mapped else 'Loaded'} retrieval index generation {generation} with {len(self)} records")
+        return True
+
+    def try_lead(self):
+        """Take leader.lock if no other process holds it. Without fcntl every process is its own leader."""
+        if self.role == "leader":
+            return True
+        if fcntl is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            handle = open(os.path.join(self.directory, "leader.lock"), "a+")
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                handle.close()
+                return False
+            self.leader_lock = handle  # held for the life of the process
+        self.role = "leader"
+        return True
+
+    def _lead(self):
+        """Become the leader: mutable state from the newest generation (or a fresh build), then publish changes."""
+        with span("corpus_snapshot"):
+            infoDatabase = getInformationDB()
+        with span("index_build"):
+            generation = self.current_generation()
+            if generation is not None and self.load_generation(generation, mapped=False):
+                self.sync(infoDatabase)
+            else:
+                self.rebuild(infoDatabase)
+        if self.publisher is None:
+            self.publisher = threading.Thread(target=self._publish_loop, daemon=True, name="index-publisher")
+            self.publisher.start()
+
+    def _publish_loop(self):
+        while True:
+            time.sleep(INDEX_PUBLISH_INTERVAL)
+            if self.dirty:
+                try:
+                    self.refresh()  # a generation published by another process is merged in, not overwritten
+                    self.publish()
+                except Exception as e:
+                    print(f"❌ Could not publish the retrieval index: {e}")
+                    self.dirty = True  # snapshot() cleared it; retry on the next round
+
+    def refresh(self):
+        """Pick up a generation published by another process; a follower also takes over if the leader is gone."""
+        now = time.time()
+        if self.directory is None or now - self.checked_at < INDEX_REFRESH_INTERVAL:
+            return
+        self.checked_at = now
+        if self.role == "follower" and self.try_lead():
+            print("👑 Took over as retrieval index leader")
+            with self.lock:
+                self._lead()
+            return
+        generation = self.current_generation()
+        if generation is not None and generation != self.generation and generation > (self.generation or 0):
+            if self.role == "follower":
+                self.load_generation(generation, mapped=True)
+                return
+            # For the leader this is e.g. `flask rebuild-index` run from another process: adopt it, then re-apply
+            # the corpus changes it may not have (including this leader's unpublished ones)
+            with self.lock:
+                if self.load_generation(generation, mapped=False):
+                    self.sync(getInformationDB())
+
+    def sync(self, infoDatabase):
+        """Bring an index loaded from disk up to date with the corpus (changed, new and deleted documents)."""
+        with self.lock:
+            for collection_name in RAG_COLLECTIONS:
+                documents = infoDatabase.get(collection_name, [])
+                watermark = self.watermarks.get(collection_name, datetime.datetime.min)
+                changed = [item for item in documents
+                           if f"{collection_name}/{item.get('_id')}" not in self.doc_ids
+                           or (isinstance(item.get("updated_at"), datetime.datetime) and item["updated_at"] > watermark)]
+                self.upsert_documents(collection_name, changed, save=False)
+                live = {f"{collection_name}/{item.get('_id')}" for item in documents}
+                for doc_key in [k for k in self.doc_ids if k.startswith(collection_name + "/") and k not in live]:
+                    self.remove_document(collection_name, doc_key.split("/", 1)[1])
+            self.dirty = True
+
+    def apply_changes(self, collection_name, upserted, deleted_ids):
+        """Corpus cache listener: mirror inserts/updates/deletes into the index."""
+        if collection_name not in RAG_COLLECTIONS:
+            return
+        with self.lock:
+            if not self.ready or self.role != "leader":
+                return  # ensure_ready() picks these up from the corpus snapshot; followers get them from the leader
+            for doc_id in deleted_ids:
+                self.remove_document(collection_name, doc_id)
+            self.upsert_documents(collection_name, upserted, save=True)
+
+    def ensure_ready(self):
+        if self.ready:
+            self.refresh()
+            return
+        with self.lock:
+            if not self.ready:
+                # Runs on first use, i.e. after gunicorn has forked, so each worker decides its own role
+                if self.try_lead():
+                    self._lead()
+                else:
+                    self.role = "follower"
+                    with span("index_map"):
+                        # No waiting for the leader's first build: serve without retrieval until refresh() finds it
+                        generation = self.current_generation()
+                        if generation is None or not self.load_generation(generation, mapped=True):
+                            print("⚠️ No retrieval index published yet; retrieval stays empty until the leader publishes one")
+                self.checked_at = time.time()
+                self.ready = True
+
+    def search(self, userInputEmbedding, k, query_text=None):
+        """
+        Hybrid search: vector and BM25 candidates (HYBRID_VECTOR_K / HYBRID_LEXICAL_K of each)
+        fused with reciprocal rank fusion. Without query_text this is a plain vector search.
+        """
+        return self.search_batch(userInputEmbedding, k, [query_text])[0]
+
+    def search_batch(self, queryEmbeddings, k, query_texts=None):
+        """search() for many queries at once: one FAISS call over the whole (n, d) query matrix."""
+        queries = np.asarray(queryEmbeddings, dtype="float32")
+        queries = queries.reshape(-1, queries.shape[-1])
+        query_texts = query_texts or [None] * len(queries)
+        # Lexical search runs outside the index lock (BM25Index guards itself, mapped postings are immutable)
+        lexical = self.lexical
+        lexical_results = [[doc_id for doc_id, _ in lexical.search(query_text, HYBRID_LEXICAL_K)] if query_text else []
+                           for query_text in query_texts]
+        with self.lock:
+            found = None
+            if self.index is not None and self.index.ntotal > 0:
+                vector_k = max(k, HYBRID_VECTOR_K) if any(query_texts) else k
+                # Over-fetch by the number of tombstones, which are dropped below
+                found = self.index.search(queries, min(vector_k + len(self.tombstones), self.index.ntotal))
+
+            batchResults = []
+            for row in range(len(queries)):
+                vector_hits, distances = [], {}
+                if found is not None:
+                    for distance, faiss_id in zip(found[0][row], found[1][row]):
+                        if faiss_id >= 0 and int(faiss_id) in self.records:
+                            vector_hits.append(int(faiss_id))
+                            distances[int(faiss_id)] = distance
+                    vector_hits = vector_hits[:vector_k]
+                # Documents removed since the lexical search ran are dropped
+                lexical_hits = [doc_id for doc_id in lexical_results[row] if doc_id in self.records]
+
+                knnResults = []
+                for faiss_id, score in rrf_fuse([vector_hits, lexical_hits], k):
+                    record = self.records[faiss_id]
+                    vector = None
+                    if faiss_id in distances:
+                        vector = self.index.reconstruct(faiss_id).tolist()  # Convert to list for JSON compatibility
+                    knnResults.append({
+                        "point": record["mainPoint"],
+                        "document": record["elabContent"],
+                        "vector": vector,
+                        "distance": distances.get(faiss_id),
+                        "score": score,
+                        "index": faiss_id,
+                        "source": record["key"],
+                    })
+                batchResults.append(knnResults)
+            return batchResults
+
+# Function to retrieve the most similar (nearest) documents using the persistent FAISS index,
+# with the user's own upload passages fused in (when relevant enough) when a user is given
+def retrieve_top_k_documents(userInputEmbedding, k, query_text=None, user_id=None):
+    retrieval_index.ensure_ready()
+    with span("index_search"):
+        knnResults = retrieval_index.search(userInputEmbedding, k, query_text)
+    if user_id is not None:
+        with span("upload_search"):
+            knnResults = fuse_upload_hits(knnResults, search_uploads(user_id, userInputEmbedding, query_text), k)
+    return knnResults if knnResults else None
 
 #################################################
 
-# Global dictionary to track scraping tasks
-scraping_tasks = {}
+# Scraping task status lives in the scrape_jobs collection (see ScrapeJobQueue)
 
 # ---------------------- Configuration ----------------------
 app = Flask(__name__)
@@ -150,7 +1082,7 @@ app.config.update(
 )
 
 # CSRF (protects all POST/PUT/DELETE by default)
-CSRFProtect(app)
+csrf = CSRFProtect(app)
 
 # Basic security headers (CSP tuned for Bootstrap CDN)
 csp = {
@@ -177,6 +1109,146 @@ app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', os.path.join(os.pa
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB upload limit
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif', 'txt', 'pdf'])
 
+ollama_warmup_once = threading.Lock()  # taken on the first request and never released
+
+@app.before_request
+def start_ollama_warmup():
+    # Runs after gunicorn has forked; workers after the first find the models loaded and skip them
+    if OLLAMA_WARMUP and ollama_warmup_once.acquire(blocking=False):
+        threading.Thread(target=warm_up_ollama, daemon=True, name="ollama-warmup").start()
+
+# ---------------------- Metrics ----------------------------
+# Print one JSON line per chat request / scrape job with the duration of every stage (histograms are always collected)
+REQUEST_LOG_JSON = os.environ.get('REQUEST_LOG_JSON', '0') == '1'
+# Optional bearer token required to read /metrics
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN') or None
+# Each gunicorn worker keeps its own histograms and counters; they write them here every METRICS_FLUSH_INTERVAL
+# seconds and /metrics adds them up, whichever worker answers the scrape. Exited workers' counters are kept in a
+# retired file; files of earlier server runs are removed. Empty = report this process only.
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(os.path.dirname(__file__), 'instance', 'metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+def format_labels(pairs):
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}" if pairs else ""
+
+class Histogram:
+    """Prometheus-style histogram (cumulative buckets, sum and count), one series per combination of label values."""
+    registry = []
+
+    def __init__(self, name, documentation, buckets, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.series = {}  # label values -> {"buckets": [count per bucket], "sum", "count"}
+        Histogram.registry.append(self)
+
+    def observe(self, value, *labelvalues):
+        with self.lock:
+            series = self.series.get(labelvalues)
+            if series is None:
+                series = self.series[labelvalues] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def snapshot(self):
+        """[label values, series] pairs, copied so they can be written out while observations continue."""
+        with self.lock:
+            return [[list(labelvalues), {"buckets": list(series["buckets"]), "sum": series["sum"], "count": series["count"]}]
+                    for labelvalues, series in self.series.items()]
+
+    @staticmethod
+    def merge(snapshots):
+        """Add up snapshots (e.g. one per worker process) into a label values -> series dict."""
+        merged = {}
+        for snapshot in snapshots:
+            for labelvalues, series in snapshot:
+                total = merged.setdefault(tuple(labelvalues), {"buckets": [0] * len(series["buckets"]), "sum": 0.0, "count": 0})
+                total["buckets"] = [a + b for a, b in zip(total["buckets"], series["buckets"])]
+                total["sum"] += series["sum"]
+                total["count"] += series["count"]
+        return merged
+
+    def render(self, series=None):
+        """Exposition of this process's series, or of the given merged ones."""
+        if series is None:
+            series = self.merge([self.snapshot()])
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labelvalues, values in sorted(series.items()):
+            labels = list(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, count in zip(self.buckets, values["buckets"]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(labels + [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(labels + [('le', '+Inf')])} {values['count']}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {values['sum']}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {values['count']}")
+        return "\n".join(lines)
+
+stage_seconds = Histogram("rag_stage_seconds", "Time spent in each stage of the chat and scrape pipelines.",
+                          LATENCY_BUCKETS, ("pipeline", "stage"))
+chat_tokens = Histogram("rag_chat_tokens", "Approximate prompt and response sizes in tokens (characters / 4).",
+                        TOKEN_BUCKETS, ("kind",))
+ollama_seconds = Histogram("rag_ollama_request_seconds", "Ollama request latency by model and endpoint; state=cold when the model was not loaded yet.",
+                           LATENCY_BUCKETS, ("model", "endpoint", "state"))
+
+class Trace:
+    """Stage durations of one chat request or scrape job, logged as a single JSON line when REQUEST_LOG_JSON is on."""
+    local = threading.local()
+
+    def __init__(self, pipeline, **fields):
+        self.pipeline = pipeline
+        self.fields = fields
+        self.spans = {}
+        self.started = time.perf_counter()
+
+    @classmethod
+    def current(cls):
+        return getattr(cls.local, "trace", None)
+
+    @contextmanager
+    def activate(self):
+        """Make this the trace that span() reports to on the current thread."""
+        previous = Trace.current()
+        Trace.local.trace = self
+        try:
+            yield self
+        finally:
+            Trace.local.trace = previous
+
+    def record(self, stage, seconds):
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def finish(self, **fields):
+        self.fields.update(fields)
+        total = time.perf_counter() - self.started
+        stage_seconds.observe(total, self.pipeline, "total")
+        if REQUEST_LOG_JSON:
+            print(json.dumps({
+                "event": self.pipeline, **self.fields, "total_ms": round(total * 1000, 2),
+                "spans_ms": {stage: round(seconds * 1000, 2) for stage, seconds in self.spans.items()},
+            }, default=str), flush=True)
+
+@contextmanager
+def span(stage, pipeline=None):
+    """Time a block into rag_stage_seconds and into the current thread's trace, if any."""
+    trace = Trace.current()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        stage_seconds.observe(seconds, pipeline or (trace.pipeline if trace else "other"), stage)
+        if trace is not None:
+            trace.record(stage, seconds)
+
     
 # ---------------------- MongoDB ----------------------------
 client = MongoClient(app.config['MONGO_URI'])
@@ -186,22 +1258,294 @@ users_col = db['users']
 msgs_col = db['messages']
 sources_col = db['sources']  # new collection for entries (title, url, type)
 
+summaries_col = db['conversation_summaries']  # rolling summary of older turns, one per user conversation
+
 # Ensure indexes
 users_col.create_index('email', unique=True, name='uniq_email')
 sources_col.create_index([('created_at', -1)], name='created_at_desc')
+msgs_col.create_index([('user_id', 1), ('created_at', -1)], name='user_created_at')
+summaries_col.create_index('user_id', unique=True, name='uniq_user')
 
 #################################################
+class CorpusCache:
+    """
+    Process-wide cache of the RAG corpus (projected to CORPUS_PROJECTION).
+    Loaded once, then kept current by a Mongo change stream, or by polling updated_at on a standalone mongod,
+    so chat requests never read the corpus from Mongo.
+    """
+
+    def __init__(self, database, collection_names):
+        self.database = database
+        self.collection_names = collection_names
+        self.lock = threading.RLock()
+        self.documents = {}   # collection -> {str(_id): document}
+        self.watermarks = {}  # collection -> newest updated_at seen (polling fallback)
+        self.listeners = []   # callables (collection_name, upserted_docs, deleted_ids)
+        self.loaded = False
+        self.watcher = None
+        self.start_time = None  # cluster time taken before the load; the change stream starts there
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    @staticmethod
+    def _project(item):
+        projected = {k: v for k, v in item.items() if k == "_id" or (k in CORPUS_PROJECTION and k != "content_sections")}
+        if "content_sections" in item:
+            projected["content_sections"] = [
+                {k: v for k, v in section.items() if k in ("title", "content", "embeddings")}
+                for section in item.get("content_sections") or []
+            ]
+        return projected
+
+    def _bump_watermark(self, collection_name, item):
+        updated_at = item.get("updated_at")
+        if isinstance(updated_at, datetime.datetime) and updated_at > self.watermarks.get(collection_name, datetime.datetime.min):
+            self.watermarks[collection_name] = updated_at
+
+    def _notify(self, collection_name, upserted, deleted_ids):
+        for listener in self.listeners:
+            try:
+                listener(collection_name, upserted, deleted_ids)
+            except Exception as e:
+                print(f"⚠️ Corpus listener failed for {collection_name}: {e}")
+
+    def load(self):
+        with self.lock:
+            # Taken before reading, so writes made during the load are replayed by the change stream (replays are
+            # idempotent: each change re-reads the document). No operationTime on a standalone mongod.
+            try:
+                self.start_time = self.database.command("ping").get("operationTime")
+            except PyMongoError:
+                self.start_time = None
+            self.documents = {}
+            for collection_name in self.collection_names:
+                docs = self.database[collection_name].find({}, CORPUS_PROJECTION)
+                self.documents[collection_name] = {str(item["_id"]): item for item in docs}
+                for item in self.documents[collection_name].values():
+                    self._bump_watermark(collection_name, item)
+            self.loaded = True
+
+    def ensure_loaded(self):
+        if self.loaded:
+            return
+        with self.lock:
+            if not self.loaded:
+                self.load()
+                # Started lazily so each (forked) gunicorn worker gets its own watcher thread
+                self.watcher = threading.Thread(target=self._watch, daemon=True)
+                self.watcher.start()
+
+    def snapshot(self):
+        self.ensure_loaded()
+        with self.lock:
+            return {name: list(docs.values()) for name, docs in self.documents.items()}
+
+    def upsert(self, collection_name, items):
+        """Apply documents written by this process right away, without waiting for the watcher."""
+        if collection_name not in self.collection_names or not self.loaded:
+            return  # a process that never loaded the cache does not need to follow it
+        items = [self._project(item) for item in items]
+        with self.lock:
+            for item in items:
+                self.documents.setdefault(collection_name, {})[str(item["_id"])] = item
+                self._bump_watermark(collection_name, item)
+        self._notify(collection_name, items, [])
+
+    def delete(self, collection_name, doc_ids):
+        if collection_name not in self.collection_names or not self.loaded:
+            return
+        doc_ids = [str(doc_id) for doc_id in doc_ids]
+        with self.lock:
+            for doc_id in doc_ids:
+                self.documents.get(collection_name, {}).pop(doc_id, None)
+        self._notify(collection_name, [], doc_ids)
+
+    def _watch(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": self.collection_names}}}]
+        resume_token = None
+        while True:
+            try:
+                position = {"resume_after": resume_token} if resume_token else {"start_at_operation_time": self.start_time}
+                with self.database.watch(pipeline, **position) as stream:
+                    print("✅ Watching RAG corpus via change stream")
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        self._apply_change(change)
+            except OperationFailure as e:
+                # Change streams need a replica set; fall back to polling on a standalone mongod
+                print(f"⚠️ Change streams unavailable ({e}); polling RAG corpus every {CORPUS_POLL_INTERVAL}s")
+                self._poll()
+                return
+            except PyMongoError as e:
+                print(f"⚠️ Change stream interrupted ({e}); reconnecting")
+                time.sleep(CORPUS_POLL_INTERVAL)
+
+    def _apply_change(self, change):
+        collection_name = change["ns"]["coll"]
+        doc_id = change["documentKey"]["_id"]
+        if change["operationType"] == "delete":
+            self.delete(collection_name, [doc_id])
+        elif change["operationType"] in ("insert", "update", "replace"):
+            item = self.database[collection_name].find_one({"_id": doc_id}, CORPUS_PROJECTION)
+            if item is not None:
+                self.upsert(collection_name, [item])
+
+    def _poll(self):
+        while True:
+            time.sleep(CORPUS_POLL_INTERVAL)
+            try:
+                for collection_name in self.collection_names:
+                    collection = self.database[collection_name]
+                    watermark = self.watermarks.get(collection_name, datetime.datetime.min)
+                    changed = list(collection.find({"updated_at": {"$gt": watermark}}, CORPUS_PROJECTION))
+                    if changed:
+                        self.upsert(collection_name, changed)
+                    # Deletes leave no watermark behind, so reconcile ids (cheap: _id only)
+                    live = {str(item["_id"]) for item in collection.find({}, {"_id": 1})}
+                    with self.lock:
+                        gone = [doc_id for doc_id in self.documents.get(collection_name, {}) if doc_id not in live]
+                    if gone:
+                        self.delete(collection_name, gone)
+            except PyMongoError as e:
+                print(f"⚠️ Corpus poll failed: {e}")
+
+# Loaded only where the whole corpus is needed: the index leader, index rebuilds and benchmarks
+corpus_cache = CorpusCache(db_rag, RAG_COLLECTIONS)
+# Every worker annotates codenames, so each keeps (only) the small Abbreviations collection
+abbreviation_cache = CorpusCache(db_rag, ["Abbreviations"])
+
 # Retrieve data (& embeddings) from information database
 def getInformationDB():
-    all_data = {}
+    return corpus_cache.snapshot()
 
-    # Loop through each collection and extract all data from RAG database (on stored embeddings from database)
-    for collection_name in db_rag.list_collection_names():
-        collection = db_rag[collection_name]
-        documents = list(collection.find({}))  # fetch all docs
-        all_data[collection_name] = documents  # append to master dict
+retrieval_index = RetrievalIndex(VECTOR_INDEX_DIR)
+corpus_cache.subscribe(retrieval_index.apply_changes)
 
-    return all_data
+abbreviation_matcher = AbbreviationMatcher(lambda: abbreviation_cache.snapshot().get("Abbreviations", []))
+abbreviation_cache.subscribe(abbreviation_matcher.on_corpus_change)
+
+#################################################
+
+# ---------------------- Embedding Worker -------------------
+# Number of texts sent to the embedding model per call
+EMBED_BATCH_SIZE = int(os.environ.get('EMBED_BATCH_SIZE', '32'))
+
+def content_hash(text):
+    # The model name is part of the hash so switching embedding models re-embeds everything
+    return hashlib.sha256(f"{EMBEDDING_MODEL_NAME}\n{text}".encode("utf-8")).hexdigest()
+
+def find_pending_embeddings(collection_name, query=None):
+    """
+    Yield (update filter, field prefix, text, hash) for every term/feature/section whose stored
+    embedding_hash doesn't match its current text, i.e. that has no vector yet or has changed since.
+    """
+    # Leave the vectors (and full_text) on the server, only the text and hashes are needed here
+    projection = {"embedding": 0, "content_sections.embeddings": 0, "full_text": 0}
+    for item in db_rag[collection_name].find(query or {}, projection):
+        if collection_name == "webscrapped_data":
+            for i, section in enumerate(item.get("content_sections") or []):
+                text = f"{section.get('title', '')}\n{section.get('content', '')}".strip()
+                digest = content_hash(text)
+                if text and section.get("embedding_hash") != digest:
+                    # Guard on the section content so a concurrent re-scrape isn't overwritten with a stale vector
+                    yield {"_id": item["_id"], f"content_sections.{i}.content": section.get("content")}, f"content_sections.{i}.", text, digest
+        elif collection_name == "passages":
+            # Law and section names give a passage cut from the middle of a section its context
+            text = f"{item.get('law_name', '')} - {item.get('section_title', '')}\n{item.get('text', '')}".strip()
+            digest = content_hash(text)
+            if item.get("text") and item.get("embedding_hash") != digest:
+                yield {"_id": item["_id"], "text": item.get("text")}, "", text, digest
+        else:
+            term = item.get("term", item.get("feature_name", ""))
+            explanation = item.get("explanation", item.get("feature_description", ""))
+            text = f"{term}: {explanation}".strip(": ")
+            digest = content_hash(text)
+            if text and item.get("embedding_hash") != digest:
+                yield {"_id": item["_id"]}, "", text, digest
+
+def embed_pending(collection_names=None, query=None, batch_size=None, task_id=None):
+    """
+    Embed everything that is missing a (current) vector and write the float32 vectors back in bulk.
+    Progress is committed batch by batch, so an interrupted run simply resumes where it stopped.
+    """
+    batch_size = batch_size or EMBED_BATCH_SIZE
+    stats = {"embedded": 0, "seconds": 0.0}
+    started = time.time()
+    for collection_name in collection_names or RAG_COLLECTIONS:
+        # Scraped sections store their vector under "embeddings", terms/features under "embedding"
+        vector_field = "embeddings" if collection_name == "webscrapped_data" else "embedding"
+        pending = list(find_pending_embeddings(collection_name, query))
+        touched = set()
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            batch_started = time.time()
+            vectors = np.asarray(embedding_model.embed_documents([text for _, _, text, _ in batch]), dtype="float32")
+            now = datetime.datetime.utcnow()
+            ops = [
+                UpdateOne(update_filter, {"$set": {
+                    prefix + vector_field: pack_vector(vector),
+                    prefix + "embedding_hash": digest,
+                    "updated_at": now,
+                }})
+                for (update_filter, prefix, _, digest), vector in zip(batch, vectors)
+            ]
+            db_rag[collection_name].bulk_write(ops, ordered=False)
+            touched.update(update_filter["_id"] for update_filter, _, _, _ in batch)
+            stats["embedded"] += len(batch)
+            elapsed = time.time() - batch_started
+            print(f"🧮 {collection_name}: embedded {start + len(batch)}/{len(pending)} ({len(batch) / max(elapsed, 1e-9):.1f} docs/sec)")
+            if task_id:
+                update_scraping_task(task_id, embedding_status=f"Embedded {start + len(batch)}/{len(pending)} sections")
+        if touched:
+            # Let this process' corpus cache (and retrieval index) see the new vectors immediately
+            corpus_cache.upsert(collection_name, list(db_rag[collection_name].find({"_id": {"$in": list(touched)}}, CORPUS_PROJECTION)))
+    stats["seconds"] = time.time() - started
+    stats["docs_per_sec"] = stats["embedded"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
+
+# ---------------------- Passage Chunking ------------------
+passages_col = db_rag["passages"]
+passages_col.create_index('law_id', name='law_id')
+
+def delete_law_passages(law_ids):
+    ids = [p["_id"] for p in passages_col.find({"law_id": {"$in": list(law_ids)}}, {"_id": 1})]
+    if ids:
+        passages_col.delete_many({"_id": {"$in": ids}})
+        corpus_cache.delete("passages", ids)
+
+def write_law_passages(law):
+    """
+    (Re)write the passages of a scraped law, keeping parent section and law metadata on each one.
+    Unchanged passages are left alone so they keep their vectors; returns the number written.
+    """
+    wanted = {}
+    for section_index, section in enumerate(law.get("content_sections") or []):
+        for chunk_index, text in enumerate(split_into_passages(section.get("content") or "")):
+            wanted[f"{law['_id']}:{section_index}:{chunk_index}"] = {
+                "law_id": law["_id"],
+                "law_name": law.get("law_name"),
+                "source_url": law.get("source_url"),
+                "section_index": section_index,
+                "section_title": section.get("title"),
+                "chunk_index": chunk_index,
+                "text": text,
+                "token_count": estimate_tokens(text),
+            }
+    existing = {p["_id"]: p for p in passages_col.find({"law_id": law["_id"]}, {"text": 1, "section_title": 1, "law_name": 1})}
+    now = datetime.datetime.utcnow()
+    ops = [
+        UpdateOne({"_id": passage_id}, {"$set": {**passage, "updated_at": now}}, upsert=True)
+        for passage_id, passage in wanted.items()
+        if passage_id not in existing or any(existing[passage_id].get(k) != passage[k] for k in ("text", "section_title", "law_name"))
+    ]
+    if ops:
+        passages_col.bulk_write(ops, ordered=False)
+    stale = [passage_id for passage_id in existing if passage_id not in wanted]
+    if stale:
+        passages_col.delete_many({"_id": {"$in": stale}})
+        corpus_cache.delete("passages", stale)
+    return len(ops)
 
 #################################################
 
@@ -314,12 +1658,93 @@ def chat_history():
         }
     return jsonify([to_dict(m) for m in msgs])
 
-@app.route('/chat/send', methods=['POST'])
-@login_required
-def chat_send():
+# ---------------------- Chat History ----------------------
+# Most recent messages considered for the prompt, and the token budget they may use
+CHAT_HISTORY_MESSAGES = int(os.environ.get('CHAT_HISTORY_MESSAGES', '20'))
+CHAT_HISTORY_TOKEN_BUDGET = int(os.environ.get('CHAT_HISTORY_TOKEN_BUDGET', '1500'))
+# Summarize turns that fall out of the window into a rolling per-conversation summary
+CHAT_HISTORY_SUMMARY = os.environ.get('CHAT_HISTORY_SUMMARY', '0') == '1'
+CHAT_HISTORY_SUMMARY_BATCH = int(os.environ.get('CHAT_HISTORY_SUMMARY_BATCH', '10'))
+
+summaryTemplate = """
+Update the running summary of a conversation with the new messages below. Keep names, features, regions and
+regulations that were discussed. Reply with the updated summary only.
+
+Current summary: {summary}
+
+New messages:
+{messages}
+
+Updated summary:
+"""
+summary_chain = ChatPromptTemplate.from_template(summaryTemplate) | query_model
+summaries_in_progress = set()
+
+def format_chat_message(m):
+    speaker = "User" if m.get('role') == 'user' else "Assistant"
+    return f"{speaker}: {m.get('text', '')}"
+
+def summarize_older_turns(user_id, window_start):
+    """Fold messages older than the prompt window into the user's rolling summary (runs in the background)."""
+    try:
+        state = summaries_col.find_one({'user_id': user_id}) or {}
+        query = {'user_id': user_id, 'created_at': {'$lt': window_start}}
+        if state.get('summarized_until'):
+            query['created_at']['$gt'] = state['summarized_until']
+        pending = list(msgs_col.find(query, {'role': 1, 'text': 1, 'created_at': 1}).sort('created_at', 1))
+        if len(pending) < CHAT_HISTORY_SUMMARY_BATCH:
+            return
+        summary = summary_chain.invoke({
+            'summary': state.get('summary', '(none)'),
+            'messages': "\n".join(format_chat_message(m) for m in pending),
+        })
+        summaries_col.update_one(
+            {'user_id': user_id},
+            {'$set': {'summary': summary.strip(), 'summarized_until': pending[-1]['created_at'], 'updated_at': datetime.datetime.utcnow()}},
+            upsert=True,
+        )
+    except Exception as e:
+        print(f"⚠️ Could not update conversation summary: {e}")
+    finally:
+        summaries_in_progress.discard(user_id)
+
+def load_chat_history(user_id, exclude_id=None):
+    """
+    The user's most recent turns (oldest first) trimmed to CHAT_HISTORY_TOKEN_BUDGET, preceded by the
+    rolling summary of older turns when summaries are enabled.
+    """
+    query = {'user_id': user_id}
+    if exclude_id is not None:
+        query['_id'] = {'$ne': exclude_id}
+    recent = msgs_col.find(query, {'role': 1, 'text': 1, 'created_at': 1}).sort('created_at', -1).limit(CHAT_HISTORY_MESSAGES)
+
+    lines, used, window_start = [], 0, None
+    for m in recent:
+        line = format_chat_message(m)
+        cost = estimate_tokens(line)
+        if used + cost > CHAT_HISTORY_TOKEN_BUDGET:
+            break
+        lines.append(line)
+        used += cost
+        window_start = m['created_at']
+    lines.reverse()
+
+    if CHAT_HISTORY_SUMMARY and window_start is not None:
+        state = summaries_col.find_one({'user_id': user_id}, {'summary': 1})
+        if state and state.get('summary'):
+            lines.insert(0, f"Summary of earlier conversation: {state['summary']}")
+        if user_id not in summaries_in_progress:
+            summaries_in_progress.add(user_id)
+            threading.Thread(target=summarize_older_turns, args=(user_id, window_start), daemon=True).start()
+
+    return "\n".join(lines)
+
+# Save the posted message (and files) and return the user message document
+def save_user_message():
     text = request.form.get('message', '').strip()
     files = request.files.getlist('files')
-    saved_files = save_files(files)
+    with span("file_save"):
+        saved_files = save_files(files)
     lat = request.form.get('lat', 0)
     lon = request.form.get('lon', 0)
     acc = request.form.get('accuracy', 0)
@@ -339,59 +1764,671 @@ def chat_send():
 
     print(location_data)
     if text or saved_files:
-        msgs_col.insert_one(user_msg)
+        with span("user_insert"):
+            msgs_col.insert_one(user_msg)
+    # Extract and embed the attachments in the background so retrieval can use them
+    queue_uploads(current_user.id, saved_files)
+    return user_msg
+
+def discard_user_message(user_msg):
+    # Undo save_user_message() when the chat pool turns the request away, so a retry doesn't duplicate it
+    if "_id" in user_msg:
+        msgs_col.delete_one({"_id": user_msg["_id"]})
+
+# Build the prompt inputs (question, RAG context, chat history) for a user message
+def build_chat_inputs(user_msg):
+    #################################################
+    # Spell out internal codenames (ASL, GH, ...) so both retrieval and the model know what they mean
+    question = abbreviation_matcher.annotate(user_msg['text'])
 
-    # reply_lines = []
-    # if text:
-    #     reply_lines.append(f'You said: "{text}"')
-    # if saved_files:
-    #     reply_lines.append("I see you uploaded: " + ", ".join(saved_files))
-    # if not reply_lines:
-    #     reply_lines.append("Send a message or upload a file to get started!")
+    # Files attached to this very message should be searchable before we answer it
+    with span("upload_wait"):
+        wait_for_uploads(user_msg['files'])
 
-    #################################################
-    # Generate an embedding for the user's query.
-    userInputEmbedding = get_embeddings([user_msg])
+    # Generate an embedding for the user's query (cached for repeated questions).
+    with span("query_embedding"):
+        userInputEmbedding = get_query_embedding(question)
 
-    # Get chat data - zh's code
-    texts = [doc["text"] for doc in msgs_col.find({}, {"_id": 0, "text": 1}) if "text" in doc]
-    chatHistory = "\n".join(texts)
+    # Get this user's recent chat turns (bounded by count and token budget)
+    with span("history"):
+        chatHistory = load_chat_history(user_msg['user_id'], exclude_id=user_msg.get('_id'))
     
     # ------- Information Database Retrieval (RAG) -------
-    # Get information database data
-    infoDatabase = getInformationDB()
+    # Retrieve the most relevant documents from the persistent FAISS index
+    knnResults = retrieve_top_k_documents(userInputEmbedding, numNearestNeighbors, question, str(user_msg['user_id']))
+    with span("prompt_assembly"):
+        RAGcontext = build_rag_context(knnResults)
 
-    # Retrieve the most relevant documents using the MongoDB database and FAISS for similarity
-    knnResults = retrieve_top_k_documents(userInputEmbedding, infoDatabase, numNearestNeighbors)
-    
-    # Combine the retrieved RAG information into a single context string.
+    # print(RAGcontext)
+    return {"question" : question, "context" : RAGcontext, "chatlog" : chatHistory}
+
+# Combine the retrieved RAG information into a single context string.
+def build_rag_context(knnResults):
     RAGcontext = "Here are some relevant context information, use where applicable:"
     if knnResults != None:
         for cd in knnResults:
             if cd["document"] != []:
-                RAGcontext += "\n" + cd["document"]
-
-    # print(RAGcontext)
-    # ------- Generation of AI Output -------
-    # Provide input to give the chain (prompt + model), and store output in the "AIoutput" variable
-    AIoutput = chain.invoke({"question" : user_msg['text'], "context" : RAGcontext, "chatlog" : chatHistory})
-    #################################################
+                RAGcontext += "\n" + abbreviation_matcher.annotate(cd["document"])
+    return RAGcontext
 
+def save_bot_message(user_id, text):
     bot_msg = {
-        'user_id': ObjectId(current_user.id),
+        'user_id': user_id,
         'role': 'bot',
-        # 'text': "  \n".join(reply_lines) + AIoutput,
-        'text': AIoutput,
+        'text': text,
         'files': [],
         'created_at': datetime.datetime.utcnow(),
     }
-    msgs_col.insert_one(bot_msg)
+    with span("bot_insert"):
+        msgs_col.insert_one(bot_msg)
+    return bot_msg
+
+# ---------------------- Chat Pipeline Pool ----------------
+# Pipelines executing at once, and how many more may wait before we answer 429
+CHAT_WORKERS = int(os.environ.get('CHAT_WORKERS', '8'))
+CHAT_QUEUE_SIZE = int(os.environ.get('CHAT_QUEUE_SIZE', '32'))
+CHAT_RETRY_AFTER = int(os.environ.get('CHAT_RETRY_AFTER', '5'))
+# Generations sent to Ollama at once (the rest of the pipeline is not limited by this)
+OLLAMA_MAX_CONCURRENCY = int(os.environ.get('OLLAMA_MAX_CONCURRENCY', '2'))
+ollama_slots = threading.BoundedSemaphore(OLLAMA_MAX_CONCURRENCY)
+
+class QueueFull(Exception):
+    pass
+
+class ChatPipelinePool:
+    """Bounded thread pool with an admission limit, so slow generations queue up instead of piling onto Ollama."""
+
+    def __init__(self, workers, max_queue):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat')
+        self.lock = threading.Lock()
+        self.pending = 0   # queued + running
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def is_full(self):
+        return self.pending >= self.workers + self.max_queue
+
+    def has_room(self):
+        """Admission check before any work is done for a request; counts the rejection when full."""
+        with self.lock:
+            if self.is_full():
+                self.rejected += 1
+                return False
+            return True
+
+    def submit(self, fn, *args, **kwargs):
+        with self.lock:
+            if self.is_full():
+                self.rejected += 1
+                raise QueueFull()
+            self.pending += 1
+        return self.executor.submit(self._run, fn, args, kwargs)
+
+    def _run(self, fn, args, kwargs):
+        with self.lock:
+            self.running += 1
+        try:
+            result = fn(*args, **kwargs)
+            with self.lock:
+                self.completed += 1
+            return result
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            raise
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.pending -= 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queue_depth': self.pending - self.running, 'running': self.running,
+                'completed': self.completed, 'failed': self.failed, 'rejected': self.rejected,
+                'workers': self.workers, 'max_queue': self.max_queue,
+            }
+
+chat_pool = ChatPipelinePool(CHAT_WORKERS, CHAT_QUEUE_SIZE)
+
+# /chat/send jobs live in Mongo, so a poll can land on any gunicorn worker; the TTL index drops them after CHAT_JOB_TTL
+CHAT_JOB_TTL = int(os.environ.get('CHAT_JOB_TTL', '3600'))
+chat_jobs_col = db['chat_jobs']
+chat_jobs_col.create_index('expires_at', expireAfterSeconds=0, name='expires_at_ttl')
+
+def busy_response():
+    response = jsonify({'ok': False, 'error': 'The assistant is busy, please retry shortly.'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(CHAT_RETRY_AFTER)
+    return response
+
+# Semantic response cache: reuse an earlier answer to the same user when a question is this similar (cosine) and was answered
+# from exactly the same retrieved context, so answers go stale as soon as the underlying documents change
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', '1') == '1'
+RESPONSE_CACHE_THRESHOLD = float(os.environ.get('RESPONSE_CACHE_THRESHOLD', '0.95'))
+
+response_cache = ResponseCache(
+    max_entries=int(os.environ.get('RESPONSE_CACHE_SIZE', '512')),
+    ttl=float(os.environ.get('RESPONSE_CACHE_TTL', '3600')),
+    threshold=RESPONSE_CACHE_THRESHOLD,
+)
+
+def run_chat_pipeline(user_msg, on_token=None, trace=None, use_cache=True):
+    """Embed, retrieve, generate and persist the answer for a saved user message (runs on the chat pool)."""
+    trace = trace or Trace("chat", user_id=str(user_msg['user_id']))
+    try:
+        with trace.activate():
+            inputs = build_chat_inputs(user_msg)
+            prompt_tokens = estimate_tokens(prompt.format(**inputs))
+            AIoutput = None
+            if RESPONSE_CACHE and use_cache:
+                with span("response_cache"):
+                    # The query embedding was cached by build_chat_inputs, so this is a lookup
+                    userInputEmbedding = get_query_embedding(inputs["question"])
+                    AIoutput = response_cache.get(user_msg['user_id'], userInputEmbedding, inputs["context"])
+                trace.fields["cache"] = "hit" if AIoutput is not None else "miss"
+                if AIoutput is not None and on_token is not None:
+                    on_token(AIoutput)
+            else:
+                response_cache.bypass()
+                trace.fields["cache"] = "bypass"
+            if AIoutput is None:
+                with span("llm_wait"):
+                    ollama_slots.acquire()
+                try:
+                    with span("generate"), ollama_call(CHAT_MODEL_NAME, "generate"):
+                        if on_token is None:
+                            # Provide input to give the chain (prompt + model), and store output in the "AIoutput" variable
+                            AIoutput = chain.invoke(inputs)
+                        else:
+                            tokens = []
+                            for token in chain.stream(inputs):
+                                tokens.append(token)
+                                on_token(token)
+                            AIoutput = "".join(tokens)
+                finally:
+                    ollama_slots.release()
+                if RESPONSE_CACHE:
+                    response_cache.put(user_msg['user_id'], get_query_embedding(inputs["question"]), inputs["context"], AIoutput)
+            save_bot_message(user_msg['user_id'], AIoutput)
+    except Exception as e:
+        trace.finish(status="error", error=str(e))
+        raise
+    response_tokens = estimate_tokens(AIoutput)
+    chat_tokens.observe(prompt_tokens, "prompt")
+    chat_tokens.observe(response_tokens, "response")
+    trace.finish(prompt_tokens=prompt_tokens, response_tokens=response_tokens)
+    return AIoutput
+
+def run_chat_job(job_id, user_msg, **kwargs):
+    """Run the pipeline for a /chat/send job and record the outcome where every worker can read it."""
+    chat_jobs_col.update_one({"_id": job_id}, {"$set": {"status": "running", "started_at": datetime.datetime.utcnow()}})
+    try:
+        AIoutput = run_chat_pipeline(user_msg, **kwargs)
+    except Exception as e:
+        chat_jobs_col.update_one({"_id": job_id}, {"$set": {"status": "error", "error": str(e), "finished_at": datetime.datetime.utcnow()}})
+        raise
+    chat_jobs_col.update_one({"_id": job_id}, {"$set": {"status": "completed", "text": AIoutput, "finished_at": datetime.datetime.utcnow()}})
+    return AIoutput
+
+@app.route('/chat/send', methods=['POST'])
+@login_required
+def chat_send():
+    # Refuse early when the pool is already full (a request that loses the race to a full queue is undone below)
+    if not chat_pool.has_room():
+        return busy_response()
+    trace = Trace("chat", user_id=current_user.id, endpoint="send")
+    with trace.activate():
+        user_msg = save_user_message()
+
+    # ------- Generation of AI Output -------
+    now = datetime.datetime.utcnow()
+    job_id = str(ObjectId())
+    chat_jobs_col.insert_one({"_id": job_id, "user_id": current_user.id, "status": "queued", "created_at": now,
+                              "expires_at": now + datetime.timedelta(seconds=CHAT_JOB_TTL)})
+    try:
+        future = chat_pool.submit(run_chat_job, job_id, user_msg, trace=trace,
+                                  use_cache=request.values.get('no_cache') != '1')
+    except QueueFull:
+        chat_jobs_col.delete_one({"_id": job_id})
+        discard_user_message(user_msg)
+        return busy_response()
+
+    if request.values.get('async') == '1':
+        # Free this worker right away; the client polls /chat/jobs/<job_id>
+        return jsonify({'ok': True, 'job_id': job_id, 'status_url': url_for('chat_job', job_id=job_id)}), 202
+
+    try:
+        AIoutput = future.result()
+    except Exception as e:
+        print(f"❌ Chat job {job_id} failed: {e}")
+        return jsonify({'ok': False, 'status': 'error', 'job_id': job_id}), 500
+    #################################################
 
     return jsonify({'ok': True, 'messages': [
         {'role': 'user', 'text': user_msg['text'], 'files': user_msg['files']},
-        {'role': 'bot', 'text': bot_msg['text'], 'files': []},
+        {'role': 'bot', 'text': AIoutput, 'files': []},
     ]})
 
+@app.route('/chat/jobs/<job_id>')
+@login_required
+def chat_job(job_id):
+    job = chat_jobs_col.find_one({"_id": job_id, "user_id": current_user.id})
+    if job is None:
+        return jsonify({'ok': False, 'status': 'not_found'}), 404
+    if job["status"] in ("queued", "running"):
+        return jsonify({'ok': True, 'status': job["status"]})
+    if job["status"] == "error":
+        return jsonify({'ok': False, 'status': 'error'}), 500
+    return jsonify({'ok': True, 'status': 'completed', 'messages': [{'role': 'bot', 'text': job["text"], 'files': []}]})
+
+# Format one Server-Sent Event
+def sse_event(data, event=None):
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data)}\n\n"
+
+@app.route('/chat/stream', methods=['POST'])
+@login_required
+def chat_stream():
+    """Same as /chat/send, but streams the answer token by token as Server-Sent Events."""
+    if not chat_pool.has_room():
+        return busy_response()
+    trace = Trace("chat", user_id=current_user.id, endpoint="stream")
+    with trace.activate():
+        user_msg = save_user_message()
+    use_cache = request.values.get('no_cache') != '1'
+
+    # The pipeline runs on the chat pool and hands tokens over through this queue;
+    # the answer is persisted there once complete, even if the client goes away.
+    tokens = queue.Queue()
+    def produce():
+        try:
+            return run_chat_pipeline(user_msg, on_token=tokens.put, trace=trace, use_cache=use_cache)
+        finally:
+            tokens.put(None)
+    try:
+        future = chat_pool.submit(produce)
+    except QueueFull:
+        discard_user_message(user_msg)
+        return busy_response()
+
+    def generate():
+        yield sse_event({'role': 'user', 'text': user_msg['text'], 'files': user_msg['files']}, event='user')
+        while True:
+            token = tokens.get()
+            if token is None:
+                break
+            yield sse_event({'token': token})
+        try:
+            yield sse_event({'role': 'bot', 'text': future.result(), 'files': []}, event='done')
+        except Exception as e:
+            print(f"❌ Streaming generation failed: {e}")
+            yield sse_event({'message': 'Generation failed.'}, event='error')
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def process_samples():
+    """This process's counters and gauges as (name, type, help, how workers combine, [(labels, value)])."""
+    pool, cache, responses = chat_pool.stats(), query_embedding_cache.stats(), response_cache.stats()
+    return [
+        ("rag_chat_queue_depth", "gauge", "Chat pipelines waiting for a worker.", "sum", [((), pool['queue_depth'])]),
+        ("rag_chat_running", "gauge", "Chat pipelines running.", "sum", [((), pool['running'])]),
+        ("rag_chat_pipelines_total", "counter", "Chat pipelines by outcome.", "sum",
+         [((('outcome', outcome),), pool[outcome]) for outcome in ('completed', 'failed', 'rejected')]),
+        ("rag_query_embedding_cache_total", "counter", "Query embedding cache lookups by result.", "sum",
+         [((('result', 'hit'),), cache['hits']), ((('result', 'miss'),), cache['misses'])]),
+        ("rag_response_cache_total", "counter", "Response cache lookups by result.", "sum",
+         [((('result', result),), responses[key]) for result, key in (('hit', 'hits'), ('miss', 'misses'), ('bypass', 'bypassed'))]),
+        ("rag_response_cache_entries", "gauge", "Answers held in the response caches.", "sum", [((), responses['size'])]),
+        ("rag_retrieval_records", "gauge", "Records in the retrieval index.", "max", [((), len(retrieval_index))]),
+        # Last known Ollama state; the flusher must not trigger health checks of its own
+        ("rag_ollama_up", "gauge", "Whether Ollama answered the last health check.", "max", [((), int(ollama_health.up))]),
+        ("rag_ollama_model_loaded", "gauge", "Whether each model is loaded in Ollama.", "max",
+         [((('model', model_tag(name)),), int(model_tag(name) in ollama_health.loaded))
+          for name in (CHAT_MODEL_NAME, STRUCTURING_MODEL_NAME, EMBEDDING_MODEL_NAME)]),
+    ]
+
+def metrics_state():
+    return {"pid": os.getpid(), "histograms": {h.name: h.snapshot() for h in Histogram.registry}, "samples": process_samples()}
+
+metrics_file = None  # (pid, server run, path of this process's state file, lock handle held for the life of the process)
+
+@contextmanager
+def metrics_dir_lock():
+    """Serialize registering, retiring and resetting files in METRICS_DIR between processes."""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, ".lock"), "a+") as handle:
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+        yield  # closing the handle releases the lock
+
+def metrics_writers():
+    """Names (<run>-<pid>-<start ms>) of the processes that registered a state file in METRICS_DIR."""
+    return [name[:-5] for name in os.listdir(METRICS_DIR) if name.endswith(".lock") and name != ".lock"]
+
+def writer_alive(name):
+    """Whether the process behind METRICS_DIR/<name>.json still runs: it holds a lock on <name>.lock for life."""
+    if fcntl is None:
+        return pid_alive(int(name.split("-")[1]))
+    try:
+        handle = open(os.path.join(METRICS_DIR, name + ".lock"), "a+")
+    except OSError:
+        return False
+    with handle:
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True  # held, so its writer is alive (a reused pid gets a new name and lock)
+        return False
+
+def metrics_path():
+    """This process's state file, registered on first use (i.e. after gunicorn has forked)."""
+    global metrics_file
+    if metrics_file is None or metrics_file[0] != os.getpid():
+        run = str(os.getppid())  # the gunicorn master (or whatever started the server): shared by its workers
+        with metrics_dir_lock():
+            # Files of earlier server runs go: counters start from zero with the server, as Prometheus expects
+            for name in os.listdir(METRICS_DIR):
+                if name != ".lock" and not name.startswith(run + "-"):
+                    os.remove(os.path.join(METRICS_DIR, name))
+            name = f"{run}-{os.getpid()}-{int(time.time() * 1000)}"  # a reused pid still gets a new name
+            handle = open(os.path.join(METRICS_DIR, name + ".lock"), "a+")
+            if fcntl is not None:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            metrics_file = (os.getpid(), run, os.path.join(METRICS_DIR, name + ".json"), handle)
+    return metrics_file[2]
+
+def write_metrics_file(path, state):
+    # Atomically, so readers never see half a file
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+def read_metrics_file(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None  # gone, or never written
+
+def flush_metrics():
+    """Write this process's metrics to its file in METRICS_DIR."""
+    write_metrics_file(metrics_path(), metrics_state())
+
+def metrics_flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush_metrics()
+        except OSError as e:
+            print(f"⚠️ Could not write metrics to {METRICS_DIR}: {e}")
+
+metrics_flusher_once = threading.Lock()  # taken on the first request and never released
+
+@app.before_request
+def start_metrics_flusher():
+    if METRICS_DIR and metrics_flusher_once.acquire(blocking=False):
+        threading.Thread(target=metrics_flush_loop, daemon=True, name="metrics-flush").start()
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def combine_samples(states, gauges=True):
+    """Add up the counters (and gauges) of several metric states: name -> (type, help, aggregation, {labels: value})."""
+    combined = {}
+    for state in states:
+        for name, kind, documentation, aggregation, values in state["samples"]:
+            if kind == "gauge" and not gauges:
+                continue
+            totals = combined.setdefault(name, (kind, documentation, aggregation, {}))[3]
+            for labels, value in values:
+                labels = tuple(tuple(pair) for pair in labels)
+                if labels not in totals:
+                    totals[labels] = value
+                else:
+                    totals[labels] = max(totals[labels], value) if aggregation == "max" else totals[labels] + value
+    return combined
+
+def retire_dead_writers():
+    """
+    Fold the counters and histograms of exited processes into <run>-retired.json and delete their files, so totals
+    stay monotonic while the directory only holds live processes. Their gauges are dropped.
+    """
+    with metrics_dir_lock():
+        dead = [name for name in metrics_writers() if name.startswith(metrics_file[1] + "-") and not writer_alive(name)]
+        if not dead:
+            return
+        retired_path = os.path.join(METRICS_DIR, f"{metrics_file[1]}-retired.json")
+        states = [state for state in [read_metrics_file(retired_path)] +
+                  [read_metrics_file(os.path.join(METRICS_DIR, name + ".json")) for name in dead] if state]
+        write_metrics_file(retired_path, {
+            "pid": None,
+            "histograms": {h.name: [[list(labels), series] for labels, series in
+                                    Histogram.merge(state["histograms"].get(h.name, []) for state in states).items()]
+                           for h in Histogram.registry},
+            "samples": [[name, kind, documentation, aggregation, [[list(labels), value] for labels, value in totals.items()]]
+                        for name, (kind, documentation, aggregation, totals) in combine_samples(states, gauges=False).items()],
+        })
+        for name in dead:
+            for suffix in (".json", ".lock"):
+                try:
+                    os.remove(os.path.join(METRICS_DIR, name + suffix))
+                except FileNotFoundError:
+                    pass
+
+def gather_metrics():
+    """Metric states of the live processes in METRICS_DIR (this one freshly) plus the retired totals, or just this process."""
+    if not METRICS_DIR:
+        return [metrics_state()]
+    flush_metrics()
+    retire_dead_writers()
+    states = []
+    for name in os.listdir(METRICS_DIR):
+        if name.endswith(".json"):
+            state = read_metrics_file(os.path.join(METRICS_DIR, name))
+            if state is not None:
+                states.append(state)
+    return states
+
+@app.route('/metrics')
+@limiter.exempt
+def metrics():
+    """
+    Prometheus text exposition: stage histograms plus pool, cache and index gauges, added up over all worker
+    processes of this server run. Counters include workers that have exited; gauges only count live ones.
+    """
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return Response("Unauthorized\n", status=401, mimetype='text/plain')
+    states = gather_metrics()
+    lines = [histogram.render(Histogram.merge(state["histograms"].get(histogram.name, []) for state in states))
+             for histogram in Histogram.registry]
+    for name, (kind, documentation, _, totals) in combine_samples(states).items():
+        lines += [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+        lines += [f"{name}{format_labels(list(labels))} {value}" for labels, value in sorted(totals.items())]
+    return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/stats')
+@login_required
+def stats():
+    return jsonify({
+        'query_embedding_cache': query_embedding_cache.stats(),
+        'response_cache': response_cache.stats(),
+        'chat_pool': chat_pool.stats(),
+        'scrape_jobs': scrape_queue.stats(),
+        'retrieval_index': {
+            'records': len(retrieval_index),
+            'vectors': retrieval_index.index.ntotal if retrieval_index.index is not None else 0,
+            'backend': retrieval_index.backend,
+            'tombstones': len(retrieval_index.tombstones),
+            'lexical_terms': len(retrieval_index.lexical),
+            'role': retrieval_index.role,
+            'generation': retrieval_index.generation,
+        },
+        'abbreviations': len(abbreviation_matcher.explanations),
+        'ollama': ollama_health.stats(),
+    })
+
+
+# ---------------------- Compliance Screening --------------
+# Features embedded and retrieved per batch, and classifications in flight at once (each still waits for an Ollama slot)
+SCREEN_BATCH_SIZE = int(os.environ.get('SCREEN_BATCH_SIZE', '32'))
+SCREEN_CONCURRENCY = int(os.environ.get('SCREEN_CONCURRENCY', str(OLLAMA_MAX_CONCURRENCY)))
+SCREEN_TOP_K = int(os.environ.get('SCREEN_TOP_K', '5'))
+# Bearer token for scripted clients of POST /screen (curl, batch jobs); logged-in browsers still send a CSRF token
+SCREEN_API_TOKEN = os.environ.get('SCREEN_API_TOKEN') or None
+
+screeningTemplate = """
+You are a compliance analyst. Decide whether the product feature below needs geo-specific compliance logic,
+i.e. behaviour that must differ by country or region because of a law or regulation (not for business reasons
+such as a market test).
+
+Here are relevant regulations and terminology: {context}
+
+Feature: {feature_name}
+Description: {feature_description}
+
+Reply with JSON only, in the form
+{{"needs_geo_logic": "yes" | "no" | "unclear", "reasoning": "<one short paragraph>", "related_regulations": ["<regulation>", ...]}}
+"""
+screening_model = OllamaLLM(model=CHAT_MODEL_NAME, base_url=OLLAMA_BASE_URL, keep_alive=OLLAMA_KEEP_ALIVE, format="json")
+screening_chain = ChatPromptTemplate.from_template(screeningTemplate) | screening_model
+
+def read_features(text, fmt=None):
+    """Parse a CSV (with a header row) or JSONL feature list into {"id", "feature_name", "feature_description"} dicts."""
+    fmt = fmt or ('jsonl' if text.lstrip().startswith('{') else 'csv')
+    if fmt == 'jsonl':
+        rows = [json.loads(line) for line in text.splitlines() if line.strip()]
+    else:
+        rows = list(csv.DictReader(io.StringIO(text)))
+    features = []
+    for row in rows:
+        row = {str(k).strip().lower(): v.strip() if isinstance(v, str) else v for k, v in row.items() if k}
+        name = row.get('feature_name') or row.get('name') or row.get('title') or ''
+        description = row.get('feature_description') or row.get('description') or row.get('text') or ''
+        if not (name or description):
+            continue
+        # Stable id, so a resumed run recognises features it has already screened
+        feature_id = str(row.get('id') or hashlib.sha256(f"{name}\n{description}".encode("utf-8")).hexdigest()[:16])
+        features.append({"id": feature_id, "feature_name": name, "feature_description": description})
+    return features
+
+def screened_ids(lines):
+    """Ids of the features that completed without error in an earlier JSONL output (for resuming)."""
+    done = set()
+    for line in lines:
+        try:
+            result = json.loads(line)
+        except ValueError:
+            continue  # e.g. a line cut short when the previous run was interrupted
+        if isinstance(result, dict) and result.get("id") and not result.get("error"):
+            done.add(str(result["id"]))
+    return done
+
+def parse_screening(raw):
+    match = re.search(r"\{.*\}", raw, re.S)
+    try:
+        data = json.loads(match.group(0)) if match else {}
+    except ValueError:
+        data = {}
+    flag = data.get("needs_geo_logic")
+    if isinstance(flag, str):
+        flag = {"yes": True, "true": True, "no": False, "false": False}.get(flag.strip().lower())
+    elif not isinstance(flag, bool):
+        flag = None  # unclear
+    regulations = data.get("related_regulations") or []
+    if isinstance(regulations, str):
+        regulations = [regulations]
+    return {
+        "needs_geo_logic": flag,
+        "reasoning": str(data.get("reasoning") or raw.strip()),
+        "related_regulations": [str(r) for r in regulations],
+    }
+
+def classify_feature(feature, description, knnResults):
+    result = {"id": feature["id"], "feature_name": feature["feature_name"]}
+    context = "\n".join(f"- {cd['point']}: {abbreviation_matcher.annotate(cd['document'])}" for cd in knnResults)
+    try:
+        with ollama_slots, ollama_call(CHAT_MODEL_NAME, "generate"):
+            raw = screening_chain.invoke({
+                "context": context,
+                "feature_name": feature["feature_name"],
+                "feature_description": description,
+            })
+    except Exception as e:
+        print(f"❌ Screening failed for {feature['feature_name']!r}: {e}")
+        result["error"] = str(e)
+        return result
+    result.update(parse_screening(raw))
+    result["sources"] = [cd["point"] for cd in knnResults]
+    return result
+
+def screen_features(features, skip_ids=(), stats=None):
+    """
+    Yield one result per feature, in input order. Each batch is embedded with one embed_documents() call
+    (OLLAMA_EMBED_CONCURRENCY requests in flight) and retrieved with one matrix search; classifications then
+    run SCREEN_CONCURRENCY at a time. Embedding time and text count are added to `stats` when given.
+    """
+    pending = [f for f in features if f["id"] not in skip_ids]
+    retrieval_index.ensure_ready()
+    with ThreadPoolExecutor(max_workers=SCREEN_CONCURRENCY, thread_name_prefix='screen') as executor:
+        for start in range(0, len(pending), SCREEN_BATCH_SIZE):
+            batch = pending[start:start + SCREEN_BATCH_SIZE]
+            descriptions = [abbreviation_matcher.annotate(f["feature_description"]) for f in batch]
+            queries = [f"{f['feature_name']}\n{d}" for f, d in zip(batch, descriptions)]
+            started = time.perf_counter()
+            embeddings = get_embeddings(queries)
+            if stats is not None:
+                stats["embed_seconds"] = stats.get("embed_seconds", 0.0) + time.perf_counter() - started
+                stats["embedded"] = stats.get("embedded", 0) + len(queries)
+            batchResults = retrieval_index.search_batch(embeddings, SCREEN_TOP_K, queries)
+            futures = [executor.submit(classify_feature, f, d, r) for f, d, r in zip(batch, descriptions, batchResults)]
+            for future in futures:
+                yield future.result()
+
+@app.route('/screen', methods=['POST'])
+@csrf.exempt
+def screen():
+    """
+    Screen a feature list (CSV or JSONL, uploaded as `file` or posted as `features`) and stream JSONL results.
+    To resume, upload the partial output of an earlier run as `previous`; features already screened are skipped.
+    Scripts authenticate with `Authorization: Bearer $SCREEN_API_TOKEN`, browsers with their session + CSRF token.
+    """
+    authorization = request.headers.get('Authorization', '')
+    if not (SCREEN_API_TOKEN and hmac.compare_digest(authorization, f"Bearer {SCREEN_API_TOKEN}")):
+        if not current_user.is_authenticated:
+            return login_manager.unauthorized()
+        csrf.protect()
+    upload = request.files.get('file')
+    text = upload.read().decode('utf-8-sig') if upload else request.form.get('features', '')
+    try:
+        features = read_features(text, request.form.get('format'))
+    except (ValueError, csv.Error) as e:
+        return jsonify({'ok': False, 'error': f'Could not parse the feature list: {e}'}), 400
+    if not features:
+        return jsonify({'ok': False, 'error': 'No features found.'}), 400
+    previous = request.files.get('previous')
+    skip_ids = screened_ids(previous.read().decode('utf-8').splitlines()) if previous else set()
+
+    def generate():
+        for result in screen_features(features, skip_ids):
+            yield json.dumps(result) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 
 @app.route('/sources', methods=['GET', 'POST'])
 @login_required
@@ -401,6 +2438,9 @@ def sources():
     if request.method == 'POST':
         name = request.form.get('name')
         url = request.form.get('url')
+        structuring_mode = request.form.get('structuring_mode', 'llm')
+        if structuring_mode not in STRUCTURING_MODES:
+            structuring_mode = 'llm'
         if not name or not url:
             message = "Error: All fields are required!"
         else:
@@ -413,13 +2453,11 @@ def sources():
                         "name": name,
                         "url": url,
                         "scraper_type": scraper_type,
+                        "structuring_mode": structuring_mode,
                         "date_added": time.strftime("%Y-%m-%d %H:%M:%S")
                     }
                     websites_collection.insert_one(new_website)
-                    task_id = f"scrape_{int(time.time())}"
-                    thread = threading.Thread(target=background_scraper, args=(new_website, task_id))
-                    thread.daemon = True
-                    thread.start()
+                    task_id = scrape_queue.enqueue(new_website)
                     message = f"Success: Website added to database! Scraping started in background (Task ID: {task_id})"
                     return redirect(url_for('sources'))
             except Exception as e:
@@ -433,15 +2471,10 @@ def scrape_all():
     websites = list(websites_collection.find({}))
     if not websites:
         return jsonify({"message": "No websites to scrape"})
-    task_ids = []
-    for website in websites:
-        task_id = f"scrape_all_{website['_id']}_{int(time.time())}"
-        thread = threading.Thread(target=background_scraper, args=(website, task_id))
-        thread.daemon = True
-        thread.start()
-        task_ids.append(task_id)
+    # Already queued/running URLs return their existing task id instead of starting another scrape
+    task_ids = [scrape_queue.enqueue(website) for website in websites]
     return jsonify({
-        "message": f"Started scraping {len(websites)} websites",
+        "message": f"Queued scraping of {len(websites)} websites",
         "task_ids": task_ids
     })
 
@@ -467,22 +2500,461 @@ def create_demo_user():
     else:
         print("Demo user already exists.")
 
+@app.cli.command('embed-corpus')
+@click.option('--batch-size', default=EMBED_BATCH_SIZE, show_default=True, help='Texts per embedding call.')
+@click.option('--collection', 'collections', multiple=True, help='Only embed this RAG collection (repeatable).')
+def embed_corpus(batch_size, collections):
+    """flask embed-corpus [--batch-size N] [--collection NAME]"""
+    stats = embed_pending(list(collections) or None, batch_size=batch_size)
+    print(f"Embedded {stats['embedded']} texts in {stats['seconds']:.1f}s ({stats['docs_per_sec']:.1f} docs/sec)")
+
+@app.cli.command('chunk-corpus')
+def chunk_corpus():
+    """flask chunk-corpus -- cut every scraped law into retrieval passages (then run embed-corpus)"""
+    written = 0
+    for law in db_rag["webscrapped_data"].find({}, {"full_text": 0, "content_sections.embeddings": 0}):
+        written += write_law_passages(law)
+    print(f"Wrote {written} new or changed passages")
+
+@app.cli.command('rescrape')
+def rescrape():
+    """flask rescrape -- re-scrape every source inline and print what changed"""
+    totals = {"sections_unchanged": 0, "sections_changed": 0, "sections_new": 0, "sections_removed": 0}
+    for website in db_rag["regulatory_websites"].find({}):
+        try:
+            result = background_scraper(website, None)
+        except Exception as e:
+            print(f"❌ {website['name']}: {e}")
+            continue
+        for key in totals:
+            totals[key] += result.get(key, 0)
+    print("Sections: {sections_unchanged} unchanged, {sections_changed} changed, {sections_new} new, {sections_removed} removed".format(**totals))
+
+@app.cli.command('warm-up')
+def warm_up():
+    """flask warm-up -- load the Ollama models (e.g. before starting gunicorn) and show what is resident"""
+    warm_up_ollama()
+    ollama_health.check(force=True)
+    print(json.dumps(ollama_health.stats(), indent=2))
+
+@app.cli.command('rebuild-index')
+@click.option('--backend', type=click.Choice(sorted(INDEX_BACKENDS)), help='Vector index type (default: VECTOR_INDEX_BACKEND, or by corpus size).')
+def rebuild_index(backend):
+    """flask rebuild-index [--backend flat|hnsw|hnswsq8|ivf|ivfsq8|ivfpq] -- train (if needed) and build the index offline"""
+    retrieval_index.rebuild(getInformationDB(), backend)
+    print(f"Published retrieval index generation {retrieval_index.generation} to {retrieval_index.directory}; running workers switch to it within INDEX_REFRESH_INTERVAL")
+
+@app.cli.command('ann-report')
+@click.option('--backend', 'backends', multiple=True, type=click.Choice(sorted(INDEX_BACKENDS)),
+              help='Backend to measure (repeatable; default: all approximate ones).')
+@click.option('--queries', default=200, show_default=True, help='Corpus vectors held out as queries.')
+@click.option('-k', 'k', default=10, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False), help='Also write the rows as JSON.')
+def ann_report(backends, queries, k, output):
+    """flask ann-report [--backend hnsw ...] [--queries 200] [-k 10] -- recall@k and latency of each backend vs exact search"""
+    infoDatabase = getInformationDB()
+    vectors = [np.asarray(embedding, dtype="float32")
+               for collection_name in RAG_COLLECTIONS for item in infoDatabase.get(collection_name, [])
+               for _, _, _, embedding in iter_document_entries(collection_name, item)
+               if embedding is not None and len(embedding)]
+    if len(vectors) <= queries:
+        print(f"❌ Need more than {queries} embedded records, found {len(vectors)}")
+        return
+    dim = statistics.mode(len(v) for v in vectors)
+    data = np.vstack([v for v in vectors if len(v) == dim])
+    order = np.random.default_rng(0).permutation(len(data))
+    query_vectors, base = data[order[:queries]], data[order[queries:]]
+    ids = np.arange(len(base), dtype="int64")
+
+    exact = faiss.IndexFlatL2(dim)
+    exact.add(base)
+    _, truth = exact.search(query_vectors, k)
+
+    rows = []
+    for backend in backends or [b for b in sorted(INDEX_BACKENDS) if b != "flat"]:
+        started = time.perf_counter()
+        index, built = train_faiss_index(base, backend)
+        index.add_with_ids(base, ids)
+        build_seconds = time.perf_counter() - started
+        size_mb = faiss.serialize_index(index).nbytes / 1e6
+        sweep = ("nprobe", [1, 4, 16, 64, 256]) if built.startswith("ivf") else ("efSearch", [16, 32, 64, 128, 256]) if built.startswith("hnsw") else (None, [None])
+        for value in sweep[1]:
+            tune_faiss_index(index, nprobe=value if sweep[0] == "nprobe" else None, ef_search=value if sweep[0] == "efSearch" else None)
+            started = time.perf_counter()
+            _, found = index.search(query_vectors, k)
+            seconds = time.perf_counter() - started
+            recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+            rows.append({"backend": built, "param": sweep[0], "value": value, f"recall_at_{k}": float(recall),
+                         "ms_per_query": seconds * 1000 / queries, "build_seconds": build_seconds, "size_mb": size_mb})
+            print(f"{built:8} {sweep[0] or '':8} {value if value is not None else '':>5}  recall@{k} {recall:.3f}  "
+                  f"{seconds * 1000 / queries:.3f} ms/query  {size_mb:.1f} MB  (built in {build_seconds:.1f}s)")
+    print(f"Exact baseline: {len(base)} vectors, {base.nbytes / 1e6:.1f} MB")
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump({"vectors": len(base), "queries": queries, "k": k, "rows": rows}, f, indent=2)
+
+
+@app.cli.command('screen-features')
+@click.argument('input_file', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--output', type=click.Path(dir_okay=False), help='Write JSONL here instead of stdout.')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Input format (guessed by default).')
+@click.option('--resume', is_flag=True, help='Skip features already screened in --output and append to it.')
+def screen_features_command(input_file, output, fmt, resume):
+    """flask screen-features FEATURES.csv|.jsonl [--output results.jsonl] [--resume]"""
+    if resume and not output:
+        raise click.UsageError('--resume needs --output: it skips the features already written there.')
+    features = read_features(input_file.read(), fmt)
+    skip_ids = set()
+    if resume and output and os.path.exists(output):
+        with open(output, encoding='utf-8') as f:
+            skip_ids = screened_ids(f)
+    out = open(output, 'a' if resume else 'w', encoding='utf-8') if output else None
+    screened = flagged = failed = 0
+    stats = {}
+    started = time.time()
+    try:
+        for result in screen_features(features, skip_ids, stats):
+            line = json.dumps(result)
+            if out:
+                out.write(line + "\n")
+                out.flush()  # every finished feature survives an interrupted run
+            else:
+                click.echo(line)
+            screened += 1
+            failed += 1 if result.get("error") else 0
+            flagged += 1 if result.get("needs_geo_logic") else 0
+    finally:
+        if out:
+            out.close()
+    click.echo(f"Screened {screened} features ({len(skip_ids)} already done) in {time.time() - started:.1f}s: "
+               f"{flagged} need geo-specific logic, {failed} failed", err=True)
+    if stats.get("embedded"):
+        click.echo(f"Embedding: {stats['embedded']} texts in {stats['embed_seconds']:.1f}s "
+                   f"({stats['embedded'] / max(stats['embed_seconds'], 1e-9):.1f}/s, "
+                   f"OLLAMA_EMBED_CONCURRENCY={OLLAMA_EMBED_CONCURRENCY})", err=True)
+
+@app.cli.command('migrate-vectors')
+@click.option('--dtype', type=click.Choice(sorted(VECTOR_SUBTYPES)), default=VECTOR_STORAGE_DTYPE, show_default=True,
+              help='Element type to store vectors as.')
+@click.option('--batch-size', default=500, show_default=True, help='Documents per bulk write.')
+def migrate_vectors(dtype, batch_size):
+    """flask migrate-vectors [--dtype float32|float16] -- rewrite stored vectors (lists of doubles or another dtype) as packed binary"""
+    targets = [(db_rag[name], "embeddings" if name == "webscrapped_data" else "embedding")
+               for name in ["Abbreviations", "data", "passages", "webscrapped_data"]] + [(upload_chunks_col, "embedding")]
+    subtype = VECTOR_SUBTYPES[dtype]
+    def convert(value):
+        """Packed value if it needs rewriting, else None."""
+        if value is None or (isinstance(value, Binary) and value.subtype == subtype):
+            return None
+        vector = unpack_vector(value)
+        return pack_vector(vector, dtype) if vector is not None else None
+
+    for collection, field in targets:
+        nested = field == "embeddings"
+        path = f"content_sections.{field}" if nested else field
+        ops, migrated, before, after = [], 0, 0, 0
+        for doc in collection.find({path: {"$exists": True}}, {path: 1}):
+            values = [(f"content_sections.{i}.{field}", s.get(field)) for i, s in enumerate(doc.get("content_sections") or [])] if nested else [(field, doc.get(field))]
+            update = {}
+            for key, value in values:
+                packed = convert(value)
+                if packed is not None:
+                    update[key] = packed
+                    before += len(value) * 8 if isinstance(value, list) else len(value)
+                    after += len(packed)
+            if update:
+                ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": update}))
+                migrated += len(update)
+            if len(ops) >= batch_size:
+                collection.bulk_write(ops, ordered=False)
+                ops = []
+        if ops:
+            collection.bulk_write(ops, ordered=False)
+        if migrated:
+            print(f"📦 {collection.name}: packed {migrated} vectors as {dtype} ({before / 1e6:.1f} MB -> {after / 1e6:.1f} MB)")
+        else:
+            print(f"✅ {collection.name}: nothing to migrate")
+
+# ---------------------- Benchmark -------------------------
+# Replays the Q/A test set through the chat stages (without history or persistence) and reports latency, throughput
+# and retrieval quality as JSON, so runs can be diffed against each other.
+BENCH_DATASET_PATH = os.path.join(os.path.dirname(__file__), 'Test Dataset System Outputs.csv')
+BENCH_FAKE_EMBEDDING_SIZE = 768  # same width as nomic-embed-text
+
+def latency_summary(samples):
+    """Milliseconds: mean and p50/p95/p99 of a list of durations in seconds."""
+    if not samples:
+        return {}
+    values = np.asarray(samples, dtype="float64") * 1000.0
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"count": len(samples), "mean": float(values.mean()), "p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+def build_bench_index(infoDatabase, embedder=None):
+    """In-memory index over the corpus, never saved; with a stand-in embedder every record is re-embedded with it."""
+    index = RetrievalIndex(None)
+    with index.lock:
+        for collection_name in RAG_COLLECTIONS:
+            entries = [entry for item in infoDatabase.get(collection_name, []) for entry in iter_document_entries(collection_name, item)]
+            if embedder is not None and entries:
+                texts = [record_text({"mainPoint": mainPoint, "elabContent": elabContent}) for _, mainPoint, elabContent, _ in entries]
+                entries = [(key, mainPoint, elabContent, vector)
+                           for (key, mainPoint, elabContent, _), vector in zip(entries, embedder.embed_documents(texts))]
+            index._add_entries(entries)
+        index.ready = True
+    return index
+
+def bench_relevant_ids(index, answer):
+    """Reference records for a question: those whose main point (e.g. a feature name) is quoted in its answer."""
+    answer = answer.lower()
+    return {faiss_id for faiss_id, record in index.records.items()
+            if isinstance(record["mainPoint"], str) and len(record["mainPoint"]) >= 8 and record["mainPoint"].lower() in answer}
+
+def bench_question(question, k):
+    """One pass through the chat stages; returns per-stage seconds and the retrieved record ids."""
+    timings = {}
+    started = clock = time.perf_counter()
+    def lap(stage):
+        nonlocal clock
+        now = time.perf_counter()
+        timings[stage] = now - clock
+        clock = now
+
+    expanded = abbreviation_matcher.annotate(question)
+    lap("abbreviations")
+    userInputEmbedding = get_query_embedding(expanded)
+    lap("embed")
+    knnResults = retrieve_top_k_documents(userInputEmbedding, k, expanded) or []
+    RAGcontext = build_rag_context(knnResults)
+    lap("retrieve")
+    with ollama_slots:
+        chain.invoke({"question": expanded, "context": RAGcontext, "chatlog": ""})
+    lap("generate")
+    timings["total"] = time.perf_counter() - started
+    return timings, [cd["index"] for cd in knnResults]
+
+def flatten_report(report, prefix=""):
+    flat = {}
+    for key, value in report.items():
+        if isinstance(value, dict):
+            flat.update(flatten_report(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+@app.cli.command('bench')
+@click.option('--dataset', default=BENCH_DATASET_PATH, show_default=True, type=click.Path(exists=True, dir_okay=False),
+              help='CSV with Question and Answer columns.')
+@click.option('--backend', type=click.Choice(['fake', 'ollama']), default='fake', show_default=True,
+              help='fake = deterministic stand-in LLM and embedder (no Ollama needed); ollama = the real models.')
+@click.option('-k', 'k', default=numNearestNeighbors, show_default=True, help='Records retrieved per question.')
+@click.option('--clients', default='1,4,8', show_default=True, help='Concurrent client counts for the throughput runs.')
+@click.option('--llm-latency', default=0.0, show_default=True, help='Seconds the fake LLM takes per answer.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the JSON report here instead of stdout.')
+@click.option('--baseline', type=click.File('r'), help='Earlier report to compare this run against.')
+def bench(dataset, backend, k, clients, llm_latency, output, baseline):
+    """flask bench [--backend fake|ollama] [--clients 1,4,8] [--output report.json] [--baseline old.json]"""
+    global embedding_model, chain, retrieval_index, query_embedding_cache
+    with open(dataset, encoding='utf-8-sig') as f:
+        rows = [row for row in csv.DictReader(f) if row.get('Question')]
+    client_counts = [int(n) for n in clients.split(',') if n.strip()]
+
+    saved = (embedding_model, chain, retrieval_index, query_embedding_cache)
+    try:
+        if backend == 'fake':
+            from langchain_core.language_models import FakeListLLM
+            from langchain_core.runnables import RunnableLambda
+            from langchain_community.embeddings import DeterministicFakeEmbedding
+            embedding_model = DeterministicFakeEmbedding(size=BENCH_FAKE_EMBEDDING_SIZE)
+            fake_llm = FakeListLLM(responses=[row['Answer'] for row in rows])
+            if llm_latency:
+                chain = prompt | RunnableLambda(lambda value: (time.sleep(llm_latency), value)[1]) | fake_llm
+            else:
+                chain = prompt | fake_llm
+        started = time.perf_counter()
+        retrieval_index = build_bench_index(getInformationDB(), embedding_model if backend == 'fake' else None)
+        index_stats = {"records": len(retrieval_index), "build_seconds": time.perf_counter() - started,
+                       "vectors": retrieval_index.index.ntotal if retrieval_index.index is not None else 0}
+        abbreviation_matcher.ensure_built()
+
+        # Sequential pass: stage latencies and retrieval quality
+        query_embedding_cache = QueryEmbeddingCache(max_entries=len(rows) or 1, ttl=float('inf'))
+        stage_samples, recalls, reciprocal_ranks = {}, [], []
+        for row in rows:
+            timings, retrieved = bench_question(row['Question'], k)
+            for stage, seconds in timings.items():
+                stage_samples.setdefault(stage, []).append(seconds)
+            relevant = bench_relevant_ids(retrieval_index, row.get('Answer', ''))
+            if not relevant:
+                continue  # no reference record to score against
+            recalls.append(len(relevant.intersection(retrieved)) / len(relevant))
+            reciprocal_ranks.append(next((1.0 / rank for rank, faiss_id in enumerate(retrieved, 1) if faiss_id in relevant), 0.0))
+
+        # Concurrent passes: every client replays the whole dataset
+        throughput = {}
+        for n in client_counts:
+            query_embedding_cache = QueryEmbeddingCache(max_entries=len(rows) or 1, ttl=float('inf'))
+            questions = [row['Question'] for row in rows] * n
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=n, thread_name_prefix='bench') as executor:
+                totals = [timings["total"] for timings, _ in executor.map(lambda q: bench_question(q, k), questions)]
+            seconds = time.perf_counter() - started
+            throughput[str(n)] = {"requests": len(questions), "seconds": seconds,
+                                  "requests_per_sec": len(questions) / seconds if seconds else 0.0,
+                                  "latency_ms": latency_summary(totals)}
+    finally:
+        embedding_model, chain, retrieval_index, query_embedding_cache = saved
+
+    report = {
+        "created_at": datetime.datetime.utcnow().isoformat(),
+        "config": {
+            "backend": backend, "k": k, "hybrid_vector_k": HYBRID_VECTOR_K, "hybrid_lexical_k": HYBRID_LEXICAL_K,
+            "rrf_k": RRF_K, "passage_max_tokens": PASSAGE_MAX_TOKENS, "llm_latency": llm_latency,
+            "ollama_max_concurrency": OLLAMA_MAX_CONCURRENCY, "dataset": os.path.basename(dataset),
+        },
+        "index": index_stats,
+        "latency_ms": {stage: latency_summary(samples) for stage, samples in stage_samples.items()},
+        "throughput": throughput,
+        "retrieval": {
+            "questions": len(rows), "labelled": len(recalls),
+            f"recall_at_{k}": float(np.mean(recalls)) if recalls else None,
+            "mrr": float(np.mean(reciprocal_ranks)) if reciprocal_ranks else None,
+        },
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+        click.echo(f"Wrote benchmark report to {output}", err=True)
+    else:
+        click.echo(text)
+
+    if baseline:
+        before = flatten_report(json.load(baseline))
+        after = flatten_report(report)
+        for key in sorted(before.keys() & after.keys()):
+            if key.startswith(("latency_ms.", "throughput.", "retrieval.")) and before[key] != after[key]:
+                change = f" ({(after[key] - before[key]) / before[key]:+.1%})" if before[key] else ""
+                click.echo(f"{key}: {before[key]:.4g} -> {after[key]:.4g}{change}", err=True)
+
+# ---------------------- HTTP Fetching ---------------------
+# Raw responses are cached on disk and revalidated with ETag/Last-Modified, so unchanged pages cost a 304
+FETCH_CACHE_DIR = os.environ.get('FETCH_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'instance', 'http_cache'))
+FETCH_TIMEOUT = float(os.environ.get('FETCH_TIMEOUT', '30'))
+# Responses fetched within this many seconds are reused without any request (e.g. type detection, then scraping)
+FETCH_REUSE_TTL = float(os.environ.get('FETCH_REUSE_TTL', '300'))
+# Minimum delay between two requests to the same host
+FETCH_HOST_DELAY = float(os.environ.get('FETCH_HOST_DELAY', '1.0'))
+
+# One pooled, keep-alive session for all scraper traffic
+http_session = requests.Session()
+http_session.headers['User-Agent'] = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+                                      'AppleWebKit/537.36 (KHTML, like Gecko) '
+                                      'Chrome/58.0.3029.110 Safari/537.36')
+http_adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=8)
+http_session.mount('http://', http_adapter)
+http_session.mount('https://', http_adapter)
+
+class FetchedResponse:
+    """The parts of a requests.Response the scrapers use, rebuilt from the fetch cache."""
+
+    def __init__(self, url, status_code, headers, content, encoding):
+        self.url = url
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self.content = content
+        self.encoding = encoding
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} error for url: {self.url}")
+
+class HostThrottle:
+    """Per-host politeness: at most one request to a host every FETCH_HOST_DELAY seconds."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.next_slot = {}  # host -> earliest time of the next request
+
+    def wait(self, host):
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot.get(host, 0.0))
+            self.next_slot[host] = slot + self.delay
+        if slot > now:
+            time.sleep(slot - now)
+
+host_throttle = HostThrottle(FETCH_HOST_DELAY)
+recent_fetches = {}  # url -> (fetched_at, FetchedResponse)
+recent_fetches_lock = threading.Lock()
+
+def _fetch_cache_paths(url):
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    return os.path.join(FETCH_CACHE_DIR, key + '.json'), os.path.join(FETCH_CACHE_DIR, key + '.body')
+
+def fetch_url(url):
+    """GET a URL through the shared session, reusing recent downloads and revalidating cached copies."""
+    with recent_fetches_lock:
+        recent = recent_fetches.get(url)
+    if recent and time.time() - recent[0] < FETCH_REUSE_TTL:
+        return recent[1]
+
+    meta_path, body_path = _fetch_cache_paths(url)
+    meta = None
+    if os.path.exists(meta_path) and os.path.exists(body_path):
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+    conditional = {}
+    if meta and meta.get('etag'):
+        conditional['If-None-Match'] = meta['etag']
+    if meta and meta.get('last_modified'):
+        conditional['If-Modified-Since'] = meta['last_modified']
+
+    host_throttle.wait(urlparse(url).netloc)
+    with scrape_stage("fetch"):
+        response = http_session.get(url, headers=conditional, timeout=FETCH_TIMEOUT)
+
+    if response.status_code == 304 and meta:
+        print(f"♻️ Not modified, using cached copy of {url}")
+        with open(body_path, 'rb') as f:
+            fetched = FetchedResponse(url, meta['status_code'], meta['headers'], f.read(), meta.get('encoding'))
+    else:
+        fetched = FetchedResponse(url, response.status_code, dict(response.headers), response.content,
+                                  response.encoding or response.apparent_encoding)
+        if response.status_code == 200 and (response.headers.get('ETag') or response.headers.get('Last-Modified')):
+            os.makedirs(FETCH_CACHE_DIR, exist_ok=True)
+            with open(body_path + '.tmp', 'wb') as f:
+                f.write(response.content)
+            with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({
+                    'url': url, 'status_code': response.status_code, 'headers': dict(response.headers),
+                    'encoding': fetched.encoding, 'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                }, f)
+            os.replace(body_path + '.tmp', body_path)
+            os.replace(meta_path + '.tmp', meta_path)
+
+    with recent_fetches_lock:
+        now = time.time()
+        for old_url in [u for u, (t, _) in recent_fetches.items() if now - t >= FETCH_REUSE_TTL]:
+            del recent_fetches[old_url]
+        if fetched.status_code < 400:  # errors are retried, not reused
+            recent_fetches[url] = (now, fetched)
+    return fetched
 
 def auto_detect_scraper_type(url: str) -> str:
     url_lower = url.lower()
     if re.search(r"(\.pdf|/pdf)$", url, re.IGNORECASE):
         return "pdf"
-    try:
-        head_response = requests.head(url, allow_redirects=True, timeout=5)
-        content_type = head_response.headers.get("Content-Type", "").lower()
-        if "application/pdf" in content_type:
-            return "pdf"
-    except requests.RequestException:
-        pass
     if "flsenate.gov" in url_lower and "pdf" in url_lower:
         return "pdf"
     try:
-        get_response = requests.get(url, timeout=5)
+        # The same download is reused by the scraper right after, so detection costs no extra request
+        get_response = fetch_url(url)
         if "application/pdf" in get_response.headers.get("Content-Type", "").lower():
             return "pdf"
         soup = BeautifulSoup(get_response.text, 'html.parser')
@@ -497,14 +2969,9 @@ def auto_detect_scraper_type(url: str) -> str:
         return "wikipedia_generic"
     return "generic_html"
 
-def scrape_generic_html(url):
+def scrape_generic_html(url, headings=None):
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-                          'AppleWebKit/537.36 (KHTML, like Gecko) '
-                          'Chrome/58.0.3029.110 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers)
+        response = fetch_url(url)
         response.raise_for_status()
         soup = BeautifulSoup(response.text, 'html.parser')
 
@@ -535,9 +3002,13 @@ def scrape_generic_html(url):
         for element in main_content.find_all(['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'blockquote', 'pre']):
             text = element.get_text(separator=" ", strip=True)
             text_key = re.sub(r'\s+', ' ', text).lower()
-            if len(text_key) > 50 and text_key not in seen_text:
+            # Headings are kept even when short: they become section titles
+            is_heading = element.name in HEADING_TAGS and len(text_key) > 0
+            if (len(text_key) > 50 or is_heading) and text_key not in seen_text:
                 all_text.append(text)
                 seen_text.add(text_key)
+                if is_heading and headings is not None:
+                    headings.append(text)
 
         combined_text = "\n".join(all_text)
         final_text = re.sub(r'\n{2,}', '\n\n', combined_text.strip())
@@ -547,14 +3018,9 @@ def scrape_generic_html(url):
         print(f"❌ Error scraping {url}: {e}")
         return ""
     
-def scrape_wikipedia(url):
+def scrape_wikipedia(url, headings=None):
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-                          'AppleWebKit/537.36 (KHTML, like Gecko) '
-                          'Chrome/58.0.3029.110 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers)
+        response = fetch_url(url)
         response.raise_for_status()
         soup = BeautifulSoup(response.text, 'html.parser')
         
@@ -607,10 +3073,13 @@ def scrape_wikipedia(url):
             if text:
                 # Create a normalized version for duplicate detection
                 text_key = re.sub(r'\s+', ' ', text).lower()
-                # Only include substantial content (more than 30 chars) and avoid duplicates
-                if len(text_key) > 30 and text_key not in seen_text:
+                # Only include substantial content (more than 30 chars, or a heading) and avoid duplicates
+                is_heading = element.name in HEADING_TAGS
+                if (len(text_key) > 30 or is_heading) and text_key not in seen_text:
                     all_text.append(text)
                     seen_text.add(text_key)
+                    if is_heading and headings is not None:
+                        headings.append(text)
         
         # Only include lists if they contain substantial content
         for element in content_div.find_all(['ul', 'ol']):
@@ -638,57 +3107,134 @@ def scrape_wikipedia(url):
         print(f"❌ Error scraping {url}: {e}")
         return ""
 
-def scrape_pdf(url: str) -> str:
-    try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-                          'AppleWebKit/537.36 (KHTML, like Gecko) '
-                          'Chrome/58.0.3029.110 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        print(f"📄 Trying pdfplumber on {url}...")
+# ---------------------- PDF OCR ---------------------------
+# Parallel OCR workers. pytesseract runs each page in its own tesseract process, so threads are enough to use all cores.
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', str(os.cpu_count() or 2)))
+# Pages whose text layer has fewer characters than this are treated as scanned and OCR'd
+OCR_MIN_PAGE_CHARS = int(os.environ.get('OCR_MIN_PAGE_CHARS', '50'))
+OCR_CACHE_DIR = os.environ.get('OCR_CACHE_DIR', os.path.join(os.path.dirname(__file__), 'instance', 'ocr_cache'))
+ocr_executor = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix='ocr')
+
+def ocr_page_image(png_bytes):
+    text = pytesseract.image_to_string(Image.open(io.BytesIO(png_bytes)))
+    return re.sub(r'\s+', ' ', text).strip()
+
+def ocr_pdf_pages(pdf_bytes, page_numbers=None):
+    """
+    OCR the given pages (all if None) in parallel and return {page number: text}.
+    Page text is cached by PDF content hash, so re-scraping the same PDF never re-OCRs it.
+    """
+    cache_dir = os.path.join(OCR_CACHE_DIR, hashlib.sha256(pdf_bytes).hexdigest())
+    pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
+    if page_numbers is None:
+        page_numbers = range(len(pdf_document))
+
+    results, pending = {}, []
+    for page_num in page_numbers:
+        cache_path = os.path.join(cache_dir, f"{page_num}.txt")
+        if os.path.exists(cache_path):
+            with open(cache_path, encoding='utf-8') as f:
+                results[page_num] = f.read()
+        else:
+            pending.append(page_num)
+    if pending:
+        print(f"🤖 OCR on {len(pending)} page(s) with {OCR_WORKERS} workers ({len(results)} cached)")
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # Render in this thread (PyMuPDF isn't thread-safe) while a bounded window of pages is OCR'd in parallel
+    in_flight = {}
+    def collect(future):
+        page_num = in_flight.pop(future)
         try:
-            with pdfplumber.open(io.BytesIO(response.content)) as pdf:
-                all_text = []
-                for page in pdf.pages:
-                    text = page.extract_text()
-                    if text:
-                        cleaned = re.sub(r'\s+', ' ', text).strip()
-                        all_text.append(cleaned)
-                combined_text = "\n".join(all_text)
-                if combined_text and is_text_repeated(combined_text):
-                    print("⚠️ pdfplumber extracted repeated content. Falling back to OCR.")
-                elif all_text:
-                    print("✅ pdfplumber successfully extracted text.")
-                    return combined_text
+            text = future.result()
         except Exception as e:
-            print(f"⚠️ pdfplumber failed. Reason: {e}")
-            pass
-        print(f"🤖 Falling back to OCR for {url}...")
-        try:
-            pdf_document = fitz.open(stream=response.content, filetype="pdf")
-            ocr_text = []
-            for page_num in range(len(pdf_document)):
-                page = pdf_document.load_page(page_num)
-                pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
-                img_bytes = pix.tobytes("ppm")
-                text = pytesseract.image_to_string(Image.open(io.BytesIO(img_bytes)))
-                if text:
-                    cleaned_text = re.sub(r'\s+', ' ', text).strip()
-                    ocr_text.append(cleaned_text)
-            if ocr_text:
-                print("✅ OCR successfully extracted text.")
-                return "\n".join(ocr_text)
+            print(f"⚠️ OCR failed on page {page_num + 1}: {e}")
+            return
+        results[page_num] = text
+        with open(os.path.join(cache_dir, f"{page_num}.txt"), 'w', encoding='utf-8') as f:
+            f.write(text)
+    for page_num in pending:
+        if len(in_flight) >= OCR_WORKERS * 2:
+            collect(next(iter(in_flight)))
+        pix = pdf_document.load_page(page_num).get_pixmap(matrix=fitz.Matrix(2, 2))
+        in_flight[ocr_executor.submit(ocr_page_image, pix.tobytes("png"))] = page_num
+    while in_flight:
+        collect(next(iter(in_flight)))
+    return results
+
+def pdf_heading_lines(pdf):
+    """Lines set in a noticeably larger font than the body text (the PDF's heading cue)."""
+    lines, sizes = [], []
+    for page in pdf.pages:
+        rows = {}
+        for word in page.extract_words(extra_attrs=["size"]):
+            rows.setdefault(round(word["top"]), []).append(word)
+            sizes.append(word["size"])
+        for top in sorted(rows):
+            words = rows[top]
+            lines.append((" ".join(w["text"] for w in words), max(w["size"] for w in words)))
+    if not sizes:
+        return []
+    body_size = statistics.median(sizes)
+    return [text for text, size in lines if size >= body_size * 1.15 and len(text) < 120]
+
+def extract_pdf_text(pdf_bytes, headings=None, label="PDF"):
+    """Text of a PDF held in memory: the text layer where there is one, OCR for image-only pages."""
+    print(f"📄 Trying pdfplumber on {label}...")
+    page_texts = None
+    try:
+        with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+            if headings is None:
+                page_texts = [re.sub(r'\s+', ' ', page.extract_text() or '').strip() for page in pdf.pages]
             else:
-                print("❌ OCR also failed to extract any text.")
-                return ""
-        except Exception as e:
-            print(f"❌ OCR fallback failed. Reason: {e}")
-            return ""
+                # Headings are matched as whole lines, so keep the line breaks for rule-based structuring
+                page_texts = [re.sub(r'[ \t]+', ' ', page.extract_text() or '').strip() for page in pdf.pages]
+                headings.extend(pdf_heading_lines(pdf))
+    except Exception as e:
+        print(f"⚠️ pdfplumber failed. Reason: {e}")
+
+    # Decide per page: keep the text layer where there is one, OCR only image-only pages
+    if page_texts is None:
+        ocr_pages = None
+    else:
+        combined_text = "\n".join(t for t in page_texts if t)
+        if combined_text and is_text_repeated(combined_text):
+            print("⚠️ pdfplumber extracted repeated content. Falling back to OCR.")
+            ocr_pages = list(range(len(page_texts)))
+            page_texts = [""] * len(page_texts)
+        else:
+            ocr_pages = [i for i, t in enumerate(page_texts) if len(t) < OCR_MIN_PAGE_CHARS]
+            if not ocr_pages:
+                print("✅ pdfplumber successfully extracted text.")
+                return combined_text
+
+    try:
+        ocr_text = ocr_pdf_pages(pdf_bytes, ocr_pages)
+    except Exception as e:
+        print(f"❌ OCR fallback failed. Reason: {e}")
+        ocr_text = {}
+    if page_texts is None:
+        page_texts = [ocr_text[i] for i in sorted(ocr_text)]
+    else:
+        page_texts = [ocr_text.get(i) or t for i, t in enumerate(page_texts)]
+    all_text = [t for t in page_texts if t]
+    if all_text:
+        print("✅ Extracted text from text layer and OCR.")
+        return "\n".join(all_text)
+    else:
+        print("❌ OCR also failed to extract any text.")
+        return ""
+
+def scrape_pdf(url: str, headings=None) -> str:
+    try:
+        response = fetch_url(url)
+        response.raise_for_status()
     except requests.exceptions.RequestException as e:
         print(f"❌ Error downloading PDF from {url}: {e}")
         return ""
+    # PDF parsing and OCR are CPU heavy, so they have their own concurrency limit
+    with scrape_stage("parse"):
+        return extract_pdf_text(response.content, headings, url)
 
 def is_text_repeated(text: str) -> bool:
     paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
@@ -698,14 +3244,15 @@ def is_text_repeated(text: str) -> bool:
     repetition_ratio = len(unique_paragraphs) / len(paragraphs)
     return repetition_ratio < 0.5
 
-def scrape_website(url, scraper_type):
+def scrape_website(url, scraper_type, headings=None):
+    """Scrape a page's text; heading texts seen along the way are appended to `headings` when given."""
     print(f"Scraping URL: {url} with type: {scraper_type}")
     if scraper_type == "wikipedia_generic":
-        return scrape_wikipedia(url)
+        return scrape_wikipedia(url, headings)
     elif scraper_type == "pdf":
-        return scrape_pdf(url)
+        return scrape_pdf(url, headings)
     else:
-        return scrape_generic_html(url)
+        return scrape_generic_html(url, headings)
 
 def clean_extracted_text(text: str) -> str:
     junk_patterns = [
@@ -729,33 +3276,155 @@ def clean_extracted_text(text: str) -> str:
             cleaned_paragraphs.append(stripped)
     return "\n\n".join(cleaned_paragraphs)
 
-def is_ollama_running():
-    try:
-        response = requests.get("http://localhost:11434/api/tags", timeout=3)
-        return response.status_code == 200
-    except requests.exceptions.RequestException:
-        return False
-
-def process_law_content_with_ollama(content, task_id=None):
+# ---------------------- Upload Ingestion ------------------
+# Files attached in the chat are extracted, chunked and embedded in the background into a per-user index that is
+# searched alongside the shared corpus. Chunks are stored once per file content (sha256), so a file is never
+# extracted or embedded twice, whoever uploads it.
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', '2'))
+UPLOAD_TOP_K = int(os.environ.get('UPLOAD_TOP_K', '3'))
+# How long a chat answer waits for the files attached to its own message to finish ingesting
+UPLOAD_WAIT_SECONDS = float(os.environ.get('UPLOAD_WAIT_SECONDS', '60'))
+UPLOAD_INDEX_USERS = int(os.environ.get('UPLOAD_INDEX_USERS', '256'))
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+
+uploads_col = db['uploads']               # one per (user, file content): filename, status, chunk count
+upload_chunks_col = db['upload_chunks']   # passages of each distinct file, keyed "<sha256>:<chunk index>"
+uploads_col.create_index([("user_id", 1), ("sha256", 1)], unique=True)
+upload_chunks_col.create_index("sha256")
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='upload')
+pending_uploads = {}  # saved filename -> ingestion future, for answers that should wait on their attachments
+
+def extract_upload_text(filename, data):
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension == 'pdf':
+        with scrape_stage("parse"):
+            return extract_pdf_text(data, label=filename)
+    if extension in IMAGE_EXTENSIONS:
+        with scrape_stage("parse"):
+            return ocr_page_image(data)
+    return data.decode('utf-8', errors='replace')
+
+class UploadIndexes:
     """
-    Sends cleaned content to Ollama, but with a more robust JSON parsing mechanism.
+    Per-user RetrievalIndex over uploaded files, loaded from upload_chunks; the most recent users are kept.
+    A cached index is only served while the user's ready uploads are still the ones it was built from, so files
+    ingested by another worker process show up on the next question.
     """
-    ollama_url = "http://localhost:11434/api/generate"
-    model_name = "llama3"
-    cleaned_content = clean_extracted_text(content)
 
-    if not is_ollama_running():
-        msg = "❌ Ollama server is NOT running on http://localhost:11434"
-        print(msg)
-        if task_id:
-            scraping_tasks[task_id]["ollama_status"] = msg
-        paragraphs = [p.strip() for p in cleaned_content.split("\n\n") if p.strip()]
-        return [{"title": f"Section {i+1}", "content": p} for i, p in enumerate(paragraphs)]
+    def __init__(self, max_users):
+        self.max_users = max_users
+        self.lock = threading.Lock()
+        self.indexes = OrderedDict()  # user id -> (RetrievalIndex, sha256s of the uploads it holds)
 
-    if task_id:
-        scraping_tasks[task_id]["ollama_status"] = "Sending content to Ollama..."
+    @staticmethod
+    def _entries(sha, filename, chunks):
+        return [(["uploads", sha, chunk["chunk_index"]], f"{filename} (uploaded)", chunk["text"], unpack_vector(chunk.get("embedding")))
+                for chunk in chunks]
+
+    def get(self, user_id):
+        uploads = {u["sha256"]: u["filename"] for u in uploads_col.find({"user_id": ObjectId(user_id), "status": "ready"},
+                                                                          {"sha256": 1, "filename": 1})}
+        with self.lock:
+            index, shas = self.indexes.get(user_id, (None, None))
+            if index is not None and shas == set(uploads):
+                self.indexes.move_to_end(user_id)
+                return index
+        index = RetrievalIndex(None)
+        chunks = {}
+        for chunk in upload_chunks_col.find({"sha256": {"$in": list(uploads)}}).sort("chunk_index", 1):
+            chunks.setdefault(chunk["sha256"], []).append(chunk)
+        with index.lock:
+            for sha, filename in uploads.items():
+                index._add_entries(self._entries(sha, filename, chunks.get(sha, [])))
+            index.ready = True
+        with self.lock:
+            self.indexes[user_id] = (index, set(uploads))
+            self.indexes.move_to_end(user_id)
+            while len(self.indexes) > self.max_users:
+                self.indexes.popitem(last=False)
+        return index
+
+upload_indexes = UploadIndexes(UPLOAD_INDEX_USERS)
+
+def ingest_upload(user_id, filename):
+    """Extract, chunk and embed one saved upload into the user's index (runs on the upload executor)."""
+    try:
+        with open(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'rb') as f:
+            data = f.read()
+        sha = hashlib.sha256(data).hexdigest()
+        owner = {"user_id": ObjectId(user_id), "sha256": sha}
+        existing = uploads_col.find_one(owner)
+        if existing and existing["status"] == "ready":
+            print(f"♻️ {filename} was already ingested for this user")
+            return
+        uploads_col.update_one(owner, {"$set": {"filename": filename, "status": "pending", "created_at": datetime.datetime.utcnow()}}, upsert=True)
+
+        chunks = list(upload_chunks_col.find({"sha256": sha}).sort("chunk_index", 1))
+        if not chunks:
+            text = extract_upload_text(filename, data)
+            passages = split_into_passages(text)
+            chunks = [{"_id": f"{sha}:{i}", "sha256": sha, "chunk_index": i, "text": passage} for i, passage in enumerate(passages)]
+            for start in range(0, len(chunks), EMBED_BATCH_SIZE):
+                batch = chunks[start:start + EMBED_BATCH_SIZE]
+                vectors = np.asarray(embedding_model.embed_documents([c["text"] for c in batch]), dtype="float32")
+                for chunk, vector in zip(batch, vectors):
+                    chunk["embedding"] = pack_vector(vector)
+                    chunk["embedding_hash"] = content_hash(chunk["text"])
+            if chunks:
+                upload_chunks_col.bulk_write([UpdateOne({"_id": c["_id"]}, {"$set": c}, upsert=True) for c in chunks], ordered=False)
+            print(f"📎 Ingested {filename}: {len(chunks)} passages")
+        else:
+            print(f"♻️ {filename} has the same content as an earlier upload, reusing its {len(chunks)} passages")
 
-    prompt = f"""
+        # Every worker's cached index for this user notices the new ready upload on its next search
+        uploads_col.update_one(owner, {"$set": {"status": "ready", "chunks": len(chunks)}})
+    except Exception as e:
+        print(f"❌ Could not ingest upload {filename}: {e}")
+        uploads_col.update_one({"user_id": ObjectId(user_id), "filename": filename}, {"$set": {"status": "error", "error": str(e)}})
+        raise
+    finally:
+        pending_uploads.pop(filename, None)
+
+def queue_uploads(user_id, filenames):
+    for filename in filenames:
+        pending_uploads[filename] = upload_executor.submit(ingest_upload, user_id, filename)
+
+def wait_for_uploads(filenames):
+    futures = [pending_uploads[name] for name in filenames if name in pending_uploads]
+    if futures:
+        concurrent.futures.wait(futures, timeout=UPLOAD_WAIT_SECONDS)
+
+def search_uploads(user_id, userInputEmbedding, query_text=None):
+    index = upload_indexes.get(user_id)
+    return index.search(userInputEmbedding, UPLOAD_TOP_K, query_text) if len(index) else []
+
+def fuse_upload_hits(knnResults, uploadResults, k):
+    """
+    Merge the user's upload passages into the corpus results by reciprocal rank, keeping k in total. An upload
+    passage only competes if it is at least as close to the question as the farthest corpus vector hit.
+    """
+    corpus_distances = [cd["distance"] for cd in knnResults if cd.get("distance") is not None]
+    if corpus_distances:
+        cutoff = max(corpus_distances)
+        uploadResults = [cd for cd in uploadResults if cd.get("distance") is not None and cd["distance"] <= cutoff]
+    if not uploadResults:
+        return knnResults
+    by_source, rankings = {}, []
+    for results in (knnResults, uploadResults):
+        ranking = []
+        for cd in results:
+            source = tuple(cd["source"])
+            by_source[source] = cd
+            ranking.append(source)
+        rankings.append(ranking)
+    return [dict(by_source[source], score=score) for source, score in rrf_fuse(rankings, k)]
+
+# Long documents are structured in overlapping chunks, several at a time
+STRUCTURE_CHUNK_CHARS = int(os.environ.get('STRUCTURE_CHUNK_CHARS', '6000'))
+STRUCTURE_CHUNK_OVERLAP = int(os.environ.get('STRUCTURE_CHUNK_OVERLAP', '400'))
+STRUCTURE_CONCURRENCY = int(os.environ.get('STRUCTURE_CONCURRENCY', '2'))
+
+STRUCTURING_PROMPT = """
     You are a legal document processor. Your task is to structure the provided legal or regulatory text.
 
     **Your instructions:**
@@ -781,116 +3450,479 @@ def process_law_content_with_ollama(content, task_id=None):
     {cleaned_content}
     ---
     """
+
+# Short lines that look like headings ("Section 5", "§ 1234", "Article II ...", "PART 3") make good chunk boundaries
+HEADING_PATTERN = re.compile(r"^(§+\s*\d|(section|sec\.|article|chapter|part|title|schedule)\s+[\dIVXLC]+\b)", re.IGNORECASE)
+
+def looks_like_heading(paragraph):
+    return len(paragraph) < 120 and (HEADING_PATTERN.match(paragraph) is not None or not paragraph.rstrip().endswith(('.', ';', ':', ',')))
+
+def split_long_paragraph(paragraph, max_chars):
+    """Cut a paragraph longer than max_chars at sentence ends (or failing that, spaces), so no chunk exceeds it."""
+    pieces = []
+    while len(paragraph) > max_chars:
+        cut = max(paragraph.rfind(". ", 0, max_chars), paragraph.rfind("; ", 0, max_chars)) + 1
+        if cut < max_chars // 2:
+            cut = paragraph.rfind(" ", 0, max_chars)
+        if cut <= 0:
+            cut = max_chars
+        pieces.append(paragraph[:cut].strip())
+        paragraph = paragraph[cut:].strip()
+    if paragraph:
+        pieces.append(paragraph)
+    return pieces
+
+def split_for_structuring(cleaned_content, max_chars=None, overlap=None):
+    """Split text into chunks of about max_chars, breaking at headings where possible and overlapping by ~overlap chars."""
+    max_chars = max_chars or STRUCTURE_CHUNK_CHARS
+    overlap = STRUCTURE_CHUNK_OVERLAP if overlap is None else overlap
+    paragraphs = [piece for p in cleaned_content.split("\n\n") if p.strip() for piece in split_long_paragraph(p.strip(), max_chars)]
+    chunks, current, size = [], [], 0
+    for paragraph in paragraphs:
+        if current and size + len(paragraph) > max_chars:
+            # Prefer to cut just before the last heading in the second half of the chunk
+            cut = len(current)
+            for i in range(len(current) - 1, len(current) // 2, -1):
+                if looks_like_heading(current[i]):
+                    cut = i
+                    break
+            chunks.append(current[:cut])
+            carried = current[cut:]
+            # Repeat the tail of the previous chunk so sections spanning the boundary are seen whole
+            tail, tail_size = [], 0
+            for p in reversed(current[:cut]):
+                if tail_size + len(p) > overlap:
+                    break
+                tail.insert(0, p)
+                tail_size += len(p)
+            current = tail + carried
+            size = sum(len(p) for p in current)
+        current.append(paragraph)
+        size += len(paragraph)
+    if current:
+        chunks.append(current)
+    return ["\n\n".join(chunk) for chunk in chunks]
+
+def paragraph_sections(text):
+    # Fallback: one untitled section per paragraph (titles are numbered after merging)
+    return [{"title": None, "content": p.strip()} for p in text.split("\n\n") if p.strip()]
+
+def restore_uncovered_paragraphs(chunk, sections):
+    """Add the chunk's paragraphs that no parsed section contains, in document order; returns (sections, added)."""
+    normalize = lambda text: re.sub(r"\s+", " ", text).lower()
+    covered = "\n".join(normalize(sec["content"]) for sec in sections)
+    missing = [p for p in paragraph_sections(chunk) if normalize(p["content"]) not in covered]
+    # Order by where each section starts in the chunk; rewritten content keeps the previous section's place
+    placed, last = [], 0
+    for sec in sections + missing:
+        position = chunk.find(sec["content"][:80])
+        last = position if position >= 0 else last
+        placed.append((last, sec))
+    placed.sort(key=lambda item: item[0])
+    return [sec for _, sec in placed], len(missing)
+
+def structure_chunk(chunk):
+    """Send one chunk to Ollama and parse its sections as they stream in."""
+    started = time.time()
     payload = {
-        "model": model_name,
-        "prompt": prompt,
+        "model": STRUCTURING_MODEL_NAME,
+        "prompt": STRUCTURING_PROMPT.format(cleaned_content=chunk),
         "stream": True # Use streaming to handle potentially large responses
     }
-
+    parser = StreamingSectionParser()
+    sections = []
     try:
-        print("📤 Sending request to Ollama...")
-        response = requests.post(ollama_url, json=payload, stream=True, timeout=600)
-        response.raise_for_status()
-
-        ollama_output_lines = []
-        for line in response.iter_lines():
-            if line:
-                try:
-                    data = json.loads(line.decode("utf-8"))
+        with ollama_call(STRUCTURING_MODEL_NAME, "generate"):
+            response = ollama_post("/api/generate", payload, stream=True, timeout=600)
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    try:
+                        data = json.loads(line.decode("utf-8"))
+                    except json.JSONDecodeError:
+                        continue
                     if "response" in data:
-                        ollama_output_lines.append(data["response"])
-                except json.JSONDecodeError:
-                    continue
-
-        ollama_output = "".join(ollama_output_lines)
-        print("📥 Received response from Ollama.")
-        if task_id:
-            scraping_tasks[task_id]["ollama_status"] = "Processing complete ✅"
-
-        # Find all potential JSON blocks and pick the longest one
-        json_matches = re.findall(r"(\[.*\])", ollama_output, re.DOTALL)
-        if not json_matches:
+                        sections.extend(parser.feed(data["response"]))
+        sections.extend(parser.finish())
+        sections = [{"title": (sec.get("title") or "").strip() or None, "content": (sec.get("content") or "").strip()}
+                    for sec in sections]
+        sections = [sec for sec in sections if sec["content"]]
+        if not sections:
             raise ValueError("No valid JSON returned from Ollama")
+        fallback = None
+        if parser.skipped:
+            sections, kept = restore_uncovered_paragraphs(chunk, sections)
+            fallback = f"{parser.skipped} malformed section(s) from Ollama, {kept} paragraph(s) kept as-is"
+    except Exception as e:
+        fallback = str(e)
+        sections = paragraph_sections(chunk)
+    return {"sections": sections, "seconds": round(time.time() - started, 2), "chars": len(chunk), "fallback": fallback}
+
+def merge_structured_sections(chunk_sections):
+    """Concatenate per-chunk sections, dropping the duplicates produced by chunk overlap."""
+    merged = []
+    for sections in chunk_sections:
+        for sec in sections:
+            key = re.sub(r"\s+", " ", sec["content"]).lower()
+            previous = re.sub(r"\s+", " ", merged[-1]["content"]).lower() if merged else ""
+            if merged and key in previous:
+                continue  # already covered by the previous section
+            if merged and previous in key:
+                merged[-1] = sec  # the previous section was a truncated copy of this one
+                continue
+            merged.append(sec)
+    return number_untitled_sections(merged)
 
-        # Pick the longest match as it's most likely to be the full JSON object
-        json_text = max(json_matches, key=len)
-
-        sections = json.loads(json_text)
-
-        final_sections = []
-        for i, sec in enumerate(sections):
-            title = sec.get("title", f"Section {i+1}").strip()
-            content = sec.get("content", "").strip()
-            if content:
-                final_sections.append({"title": title, "content": content})
-
-        if not final_sections:
-            raise ValueError("Empty sections after parsing Ollama output")
+def number_untitled_sections(sections):
+    for i, sec in enumerate(sections):
+        sec["title"] = sec["title"] or f"Section {i+1}"
+    return sections
 
-        return final_sections
+def process_law_content_with_ollama(content, task_id=None):
+    """
+    Structures cleaned content into titled sections with Ollama: the text is split into overlapping chunks that
+    are sent concurrently, parsed as they stream back, and merged.
+    """
+    cleaned_content = clean_extracted_text(content)
 
-    except Exception as e:
-        msg = f"⚠️ Ollama failed, using paragraph fallback. Reason: {e}"
+    if not is_ollama_running():
+        msg = f"❌ Ollama server is NOT running on {OLLAMA_BASE_URL}"
         print(msg)
         if task_id:
-            scraping_tasks[task_id]["ollama_status"] = msg
-        paragraphs = [p.strip() for p in cleaned_content.split("\n\n") if p.strip()]
-        return [{"title": f"Section {i+1}", "content": p} for i, p in enumerate(paragraphs)]
+            update_scraping_task(task_id, ollama_status=msg)
+        return merge_structured_sections([paragraph_sections(cleaned_content)])
+
+    chunks = split_for_structuring(cleaned_content)
+    if task_id:
+        update_scraping_task(task_id, ollama_status=f"Sending {len(chunks)} chunk(s) to Ollama...")
+
+    print(f"📤 Sending {len(chunks)} chunk(s) to Ollama...")
+    with ThreadPoolExecutor(max_workers=max(1, min(STRUCTURE_CONCURRENCY, len(chunks))), thread_name_prefix='structure') as pool:
+        results = list(pool.map(structure_chunk, chunks))
+    print("📥 Received response from Ollama.")
+
+    timings = [{"chunk": i, "chars": r["chars"], "seconds": r["seconds"], "sections": len(r["sections"]), "fallback": r["fallback"]}
+               for i, r in enumerate(results)]
+    for t in timings:
+        status = f"paragraph fallback ({t['fallback']})" if t["fallback"] else "ok"
+        print(f"   chunk {t['chunk']}: {t['chars']} chars, {t['sections']} sections in {t['seconds']}s, {status}")
+    failed = sum(1 for t in timings if t["fallback"])
+    if task_id:
+        msg = "Processing complete ✅" if not failed else f"⚠️ {failed}/{len(chunks)} chunk(s) used paragraph fallback"
+        update_scraping_task(task_id, ollama_status=msg, structuring_chunks=timings)
+
+    return merge_structured_sections([r["sections"] for r in results])
+
+# ---------------------- Rule-based Structuring ------------
+HEADING_TAGS = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+# Per-source choice (regulatory_websites.structuring_mode): "llm" rewrites the text as JSON sections with Ollama,
+# "rules" splits on headings and statute numbering in milliseconds and only asks the LLM for missing titles
+STRUCTURING_MODES = ("llm", "rules")
+
+def title_untitled_sections(sections):
+    """Ask the LLM for titles of the sections that have none, all in one short request."""
+    untitled = [sec for sec in sections if not sec["title"]]
+    if not untitled or not is_ollama_running():
+        return
+    excerpts = "\n\n".join(f"{i+1}. {sec['content'][:500]}" for i, sec in enumerate(untitled))
+    prompt = (f"Give a concise, descriptive title (at most 8 words) for each of the {len(untitled)} numbered legal text excerpts below. "
+              f'Reply with JSON only, in the form {{"titles": ["title 1", "title 2"]}}.\n\n{excerpts}')
+    try:
+        with scrape_stage("llm"), ollama_call(STRUCTURING_MODEL_NAME, "generate"):
+            response = ollama_post("/api/generate",
+                                   {"model": STRUCTURING_MODEL_NAME, "prompt": prompt, "stream": False, "format": "json"}, timeout=120)
+            response.raise_for_status()
+        titles = json.loads(response.json().get("response", "{}")).get("titles", [])
+    except Exception as e:
+        print(f"⚠️ Could not title sections with Ollama: {e}")
+        return
+    for sec, title in zip(untitled, titles):
+        if isinstance(title, str) and title.strip():
+            sec["title"] = title.strip()
+
+def structure_by_rules(content, headings=None, task_id=None):
+    started = time.time()
+    sections = split_sections_by_rules(clean_extracted_text(content), headings)
+    print(f"📐 Rule-based structuring: {len(sections)} sections in {time.time() - started:.3f}s")
+    title_untitled_sections(sections)
+    if task_id:
+        update_scraping_task(task_id, ollama_status=f"Rule-based structuring: {len(sections)} sections")
+    # No chunk overlap to dedupe here, so the sections are kept exactly as split
+    return number_untitled_sections(sections)
 
 # --- Background Scraper (Modified) ---
 
-def background_scraper(website_data, task_id):
+# Scrape jobs (persisted so status survives restarts and is shared by all gunicorn workers)
+SCRAPE_WORKERS = int(os.environ.get('SCRAPE_WORKERS', '4'))
+SCRAPE_MAX_ATTEMPTS = int(os.environ.get('SCRAPE_MAX_ATTEMPTS', '3'))
+SCRAPE_RETRY_BACKOFF = float(os.environ.get('SCRAPE_RETRY_BACKOFF', '60'))   # seconds, doubled per attempt
+SCRAPE_POLL_INTERVAL = float(os.environ.get('SCRAPE_POLL_INTERVAL', '5'))
+SCRAPE_JOB_TIMEOUT = float(os.environ.get('SCRAPE_JOB_TIMEOUT', '1800'))     # running jobs without a heartbeat for this long are requeued
+SCRAPE_HEARTBEAT_INTERVAL = float(os.environ.get('SCRAPE_HEARTBEAT_INTERVAL', '60'))  # how often a running job renews it
+
+# Separate concurrency limits per pipeline stage, shared by all scrape workers in this process
+scrape_stage_limits = {
+    "fetch": threading.BoundedSemaphore(int(os.environ.get('SCRAPE_FETCH_CONCURRENCY', '4'))),
+    "parse": threading.BoundedSemaphore(int(os.environ.get('SCRAPE_PARSE_CONCURRENCY', '2'))),
+    "llm": threading.BoundedSemaphore(int(os.environ.get('SCRAPE_LLM_CONCURRENCY', '1'))),
+    "embed": threading.BoundedSemaphore(int(os.environ.get('SCRAPE_EMBED_CONCURRENCY', '1'))),
+}
+
+@contextmanager
+def scrape_stage(name):
+    """Run a block within the stage's concurrency limit, timing the wait for a slot and the work separately."""
+    with span(f"{name}_wait", "scrape"):
+        scrape_stage_limits[name].acquire()
     try:
-        scraping_tasks[task_id] = {"status": "running", "message": "Scraping in progress..."}
+        with span(name, "scrape"):
+            yield
+    finally:
+        scrape_stage_limits[name].release()
+
+scrape_jobs_col = db['scrape_jobs']
+# Only one active (queued/running) job per URL
+scrape_jobs_col.create_index('url', unique=True, partialFilterExpression={'active': True}, name='uniq_active_url')
+scrape_jobs_col.create_index([('status', 1), ('next_run_at', 1)], name='status_next_run_at')
+# Scraped laws are upserted by their source URL
+db_rag["webscrapped_data"].create_index('source_url', name='source_url')
+
+def update_scraping_task(task_id, **fields):
+    if task_id:
+        fields["heartbeat"] = datetime.datetime.utcnow()
+        scrape_jobs_col.update_one({"_id": task_id}, {"$set": fields})
 
-        db = client["TikTok_TechJam"]
-        scraped_data_collection = db["webscrapped_data"]
+class ScrapeError(Exception):
+    pass
 
-        raw_content = scrape_website(website_data['url'], website_data['scraper_type'])
-        if not raw_content or len(raw_content.strip()) == 0:
-            scraping_tasks[task_id] = {
-                "status": "error",
-                "message": "No content could be extracted from the website"
-            }
-            return
+class ScrapeJobQueue:
+    """
+    Mongo-backed scrape job queue. Every process runs a dispatcher that atomically claims queued jobs
+    into a bounded worker pool; failed jobs are retried with exponential backoff.
+    """
 
-        processed_sections = process_law_content_with_ollama(raw_content, task_id)
+    def __init__(self, collection, workers):
+        self.collection = collection
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(workers)
+        self.executor = None
+        self.worker_id = None
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+
+    def enqueue(self, website_data):
+        """Queue a scrape of website_data and return its task id (the existing one if the URL is already active)."""
+        now = datetime.datetime.utcnow()
+        task_id = f"scrape_{ObjectId()}"
+        try:
+            self.collection.insert_one({
+                "_id": task_id,
+                "url": website_data["url"],
+                "website": website_data,
+                "status": "queued",
+                "message": "Waiting for a scrape worker...",
+                "active": True,
+                "attempts": 0,
+                "next_run_at": now,
+                "created_at": now,
+            })
+        except DuplicateKeyError:
+            existing = self.collection.find_one({"url": website_data["url"], "active": True}, {"_id": 1})
+            if existing:
+                return existing["_id"]
+            return self.enqueue(website_data)  # the active job finished in between
+        self.ensure_started()
+        self.wakeup.set()
+        return task_id
+
+    def ensure_started(self):
+        if self.executor is not None:
+            return
+        with self.lock:
+            if self.executor is None:
+                # Started lazily so each (forked) gunicorn worker runs its own dispatcher
+                self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='scrape')
+                threading.Thread(target=self._dispatch, daemon=True).start()
+
+    def _claim(self):
+        now = datetime.datetime.utcnow()
+        return self.collection.find_one_and_update(
+            {"status": "queued", "next_run_at": {"$lte": now}},
+            {"$set": {"status": "running", "message": "Scraping in progress...", "worker": self.worker_id,
+                      "started_at": now, "heartbeat": now},
+             "$inc": {"attempts": 1}},
+            sort=[("next_run_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def _requeue_stale(self):
+        # Jobs whose worker died mid-run (no heartbeat) go back on the queue, unless they have used up their
+        # attempts: a job that keeps crashing its worker would otherwise be requeued forever
+        now = datetime.datetime.utcnow()
+        stale = {"status": "running", "heartbeat": {"$lt": now - datetime.timedelta(seconds=SCRAPE_JOB_TIMEOUT)}}
+        self.collection.update_many(
+            {**stale, "attempts": {"$gte": SCRAPE_MAX_ATTEMPTS}},
+            {"$set": {"status": "error", "active": False, "finished_at": now,
+                      "message": f"Worker timed out on all {SCRAPE_MAX_ATTEMPTS} attempts"}},
+        )
+        self.collection.update_many(
+            stale,
+            {"$set": {"status": "queued", "message": "Requeued after worker timeout", "next_run_at": now}},
+        )
+
+    def _dispatch(self):
+        while True:
+            try:
+                self._requeue_stale()
+                while self.slots.acquire(blocking=False):
+                    try:
+                        job = self._claim()
+                        if job is not None:
+                            self.executor.submit(self._run, job)  # _run releases the slot
+                    except BaseException:
+                        self.slots.release()
+                        raise
+                    if job is None:
+                        self.slots.release()
+                        break
+            except PyMongoError as e:
+                print(f"⚠️ Scrape dispatcher error: {e}")
+            self.wakeup.wait(SCRAPE_POLL_INTERVAL)
+            self.wakeup.clear()
+
+    def _heartbeat(self, task_id, stop):
+        # Renewed for as long as the job runs, however long a single stage (e.g. LLM structuring) takes
+        while not stop.wait(SCRAPE_HEARTBEAT_INTERVAL):
+            try:
+                self.collection.update_one({"_id": task_id, "status": "running", "worker": self.worker_id},
+                                           {"$set": {"heartbeat": datetime.datetime.utcnow()}})
+            except PyMongoError as e:
+                print(f"⚠️ Could not renew heartbeat of {task_id}: {e}")
+
+    def _run(self, job):
+        task_id = job["_id"]
+        trace = Trace("scrape", task_id=str(task_id), url=job["website"].get("url"), attempt=job["attempts"])
+        status = "error"
+        stop_heartbeat = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(task_id, stop_heartbeat), daemon=True).start()
+        try:
+            with trace.activate():
+                result = background_scraper(job["website"], task_id)
+            status = "completed"
+            update_scraping_task(task_id, status="completed", active=False, finished_at=datetime.datetime.utcnow(), **result)
+        except Exception as e:
+            print(f"❌ Background scraping/processing error: {e}")
+            if job["attempts"] < SCRAPE_MAX_ATTEMPTS:
+                delay = SCRAPE_RETRY_BACKOFF * (2 ** (job["attempts"] - 1))
+                update_scraping_task(task_id, status="queued", next_run_at=datetime.datetime.utcnow() + datetime.timedelta(seconds=delay),
+                                     message=f"Attempt {job['attempts']} failed ({e}); retrying in {int(delay)}s")
+            else:
+                update_scraping_task(task_id, status="error", active=False, finished_at=datetime.datetime.utcnow(),
+                                     message=f"Error during scraping or processing: {str(e)}")
+        finally:
+            stop_heartbeat.set()
+            trace.finish(status=status)
+            self.slots.release()
+            self.wakeup.set()
 
-        # Add embeddings field as empty for now
-        if processed_sections:
-            for section in processed_sections:
-                section["embeddings"] = None  # Placeholder for future embeddings
+    def stats(self):
+        counts = {row["_id"]: row["count"] for row in self.collection.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}])}
+        return {"workers": self.workers, **counts}
 
-        scraped_law = {
-            "law_name": website_data['name'],
-            "source_url": website_data['url'],
-            "full_text": raw_content,
-            "content_sections": processed_sections if processed_sections else [],
-            "scrape_date": time.strftime("%Y-%m-%d %H:%M:%S")
-        }
+scrape_queue = ScrapeJobQueue(scrape_jobs_col, SCRAPE_WORKERS)
 
-        result = scraped_data_collection.insert_one(scraped_law)
+@app.before_request
+def start_scrape_dispatcher():
+    scrape_queue.ensure_started()
 
-        scraping_tasks[task_id] = {
-            "status": "completed",
-            "message": f"Successfully scraped and processed {website_data['name']}",
-            "mongo_id": str(result.inserted_id),
-            "sections_count": len(processed_sections) if processed_sections else 0
-        }
-        print(f"✅ Successfully stored structured data for {website_data['name']}")
-        print(f"📝 Sections extracted: {len(processed_sections) if processed_sections else 0}")
+def background_scraper(website_data, task_id):
+    """
+    Scrape, structure, store and embed one website. Raises on failure so the job can be retried.
+    Re-scrapes are incremental: laws are upserted by source_url, unchanged content skips structuring and
+    embedding, and only new or changed passages are re-embedded (sections themselves carry no vectors).
+    """
+    # Scraped laws live in the RAG database so the retrieval index can see them
+    scraped_data_collection = db_rag["webscrapped_data"]
+
+    # Headings are only collected for rule-based structuring; the LLM finds its own
+    structuring_mode = website_data.get('structuring_mode') or "llm"
+    headings = [] if structuring_mode == "rules" else None
+    raw_content = scrape_website(website_data['url'], website_data['scraper_type'], headings)
+    if not raw_content or len(raw_content.strip()) == 0:
+        raise ScrapeError("No content could be extracted from the website")
+
+    # The structuring mode is part of the hash: switching a source's mode re-structures it
+    raw_hash = text_hash(f"{structuring_mode}\n{raw_content}")
+    existing = scraped_data_collection.find_one({"source_url": website_data['url']}, {"full_text": 0}, sort=[("updated_at", -1)])
+    if existing and existing.get("content_hash") == raw_hash:
+        scraped_data_collection.update_one({"_id": existing["_id"]}, {"$set": {"scrape_date": time.strftime("%Y-%m-%d %H:%M:%S")}})
+        summary = {"sections_unchanged": len(existing.get("content_sections") or []), "sections_changed": 0, "sections_new": 0, "sections_removed": 0}
+        print(f"♻️ {website_data['name']} is unchanged, skipping structuring and embedding")
+        return {"message": f"{website_data['name']} is unchanged since the last scrape", "mongo_id": str(existing["_id"]),
+                "sections_count": summary["sections_unchanged"], **summary}
+
+    if structuring_mode == "rules":
+        processed_sections = structure_by_rules(raw_content, headings, task_id)
+    else:
+        with scrape_stage("llm"):
+            processed_sections = process_law_content_with_ollama(raw_content, task_id)
+    processed_sections = processed_sections or []
+
+    summary = summarize_section_changes((existing or {}).get("content_sections") or [], processed_sections)
+
+    scraped_law = {
+        "law_name": website_data['name'],
+        "source_url": website_data['url'],
+        "full_text": raw_content,
+        "content_hash": raw_hash,
+        "content_sections": processed_sections,
+        "scrape_date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "updated_at": datetime.datetime.utcnow(),
+    }
 
+    with span("store"):
+        if existing:
+            law_id = existing["_id"]
+            scraped_data_collection.update_one({"_id": law_id}, {"$set": scraped_law})
+        else:
+            law_id = scraped_data_collection.insert_one(scraped_law).inserted_id
+    scraped_law["_id"] = law_id
+    corpus_cache.upsert("webscrapped_data", [scraped_law])
+
+    # Older runs inserted a new document per scrape; keep only the current one
+    duplicates = [d["_id"] for d in scraped_data_collection.find({"source_url": website_data['url'], "_id": {"$ne": law_id}}, {"_id": 1})]
+    if duplicates:
+        scraped_data_collection.delete_many({"_id": {"$in": duplicates}})
+        corpus_cache.delete("webscrapped_data", duplicates)
+        delete_law_passages(duplicates)
+
+    # Chunking stage: cut sections into token-bounded passages, the units retrieval works on
+    with span("chunk"):
+        written = write_law_passages(scraped_law)
+    summary["passages_written"] = written
+
+    # Embedding stage: fill in the passage vectors so the law becomes retrievable
+    try:
+        with scrape_stage("embed"):
+            embed_pending(["passages"], query={"law_id": law_id}, task_id=task_id)
     except Exception as e:
-        scraping_tasks[task_id] = {
-            "status": "error",
-            "message": f"Error during scraping or processing: {str(e)}"
-        }
-        print(f"❌ Background scraping/processing error: {e}")
+        print(f"⚠️ Embedding failed for {website_data['name']}, run `flask embed-corpus` to retry: {e}")
+
+    print(f"✅ Successfully stored structured data for {website_data['name']}")
+    print(f"📝 Sections: {summary['sections_unchanged']} unchanged, {summary['sections_changed']} changed, "
+          f"{summary['sections_new']} new, {summary['sections_removed']} removed")
+    return {
+        "message": f"Successfully scraped and processed {website_data['name']}",
+        "mongo_id": str(law_id),
+        "sections_count": len(processed_sections),
+        **summary,
+    }
 
 @app.route('/scraping_status/<task_id>')
 def scraping_status(task_id):
-    if task_id in scraping_tasks:
-        return jsonify(scraping_tasks[task_id])
+    task = scrape_jobs_col.find_one({"_id": task_id}, {"website": 0, "active": 0, "worker": 0})
+    if task:
+        return jsonify(task)
     else:
         return jsonify({"status": "not_found", "message": "Task not found"})
 
@@ -0,0 +1,479 @@
+"""
+Pure helpers behind app.py: passage chunking, BM25 and rank fusion, the abbreviation matcher, the semantic
+response cache and the rule-based / streamed section structuring. Importing this module has no side effects
+(no Flask app, MongoDB or Ollama), so it can be unit tested on its own.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# ---------------------- Passage Chunking -----------------
+# Rough token estimate (~4 characters per token) used for prompt budgeting
+def estimate_tokens(text):
+    return (len(text or "") + 3) // 4
+
+# Retrieval units: token-bounded, overlapping passages of each scraped section
+PASSAGE_MAX_TOKENS = int(os.environ.get('PASSAGE_MAX_TOKENS', '256'))
+PASSAGE_OVERLAP_TOKENS = int(os.environ.get('PASSAGE_OVERLAP_TOKENS', '32'))
+
+def split_into_passages(text, max_tokens=None, overlap_tokens=None):
+    """Split text at sentence boundaries into passages of at most max_tokens, overlapping by ~overlap_tokens."""
+    max_tokens = max_tokens or PASSAGE_MAX_TOKENS
+    overlap_tokens = PASSAGE_OVERLAP_TOKENS if overlap_tokens is None else overlap_tokens
+    # Budgets in characters: estimate_tokens(passage) <= max_tokens exactly when len(passage) <= max_chars
+    max_chars, overlap_chars = max_tokens * 4, overlap_tokens * 4
+    sentences = []
+    for sentence in re.split(r"(?<=[.;:!?])\s+|\n+", text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if len(sentence) <= max_chars:
+            sentences.append(sentence)
+            continue
+        # A single over-long sentence is hard-split, adding words while the piece still fits
+        piece = ""
+        for word in sentence.split():
+            while len(word) > max_chars:  # a "word" longer than a whole passage (e.g. a URL) is cut itself
+                if piece:
+                    sentences.append(piece)
+                    piece = ""
+                sentences.append(word[:max_chars])
+                word = word[max_chars:]
+            if piece and len(piece) + 1 + len(word) > max_chars:
+                sentences.append(piece)
+                piece = word
+            else:
+                piece = f"{piece} {word}" if piece else word
+        if piece:
+            sentences.append(piece)
+
+    passages, current, used = [], [], 0  # used: characters of " ".join(current)
+    for sentence in sentences:
+        if current and used + 1 + len(sentence) > max_chars:
+            passages.append(" ".join(current))
+            # Carry over the last sentences (up to ~overlap_tokens) that still leave room for this one
+            budget = min(overlap_chars, max_chars - 1 - len(sentence))
+            tail, tail_used = [], -1
+            for previous in reversed(current):
+                if tail_used + 1 + len(previous) > budget:
+                    break
+                tail.insert(0, previous)
+                tail_used += 1 + len(previous)
+            current, used = tail, max(tail_used, 0)
+        used += len(sentence) + (1 if current else 0)
+        current.append(sentence)
+    if current:
+        passages.append(" ".join(current))
+    return passages
+
+# ---------------------- Lexical Retrieval ----------------
+# Query words too common to be worth walking their posting lists (they barely move BM25 scores anyway)
+BM25_STOPWORDS = frozenset(
+    "a an and are at be been but by can do does for from had has have how i if in into is its may must no not of on "
+    "or our shall should so such than that the their then there these they this those to under was we were what when "
+    "where which who why will with would you your".split())
+
+def bm25_rank(postings, n, avg_length, k1, b, k):
+    """Top-k (doc key, score) pairs from per-query-term (doc keys, term frequencies, doc lengths) arrays."""
+    if not postings:
+        return []
+    docs, scores = [], []
+    for keys, tf, lengths in postings:
+        idf = np.log(1 + (n - len(keys) + 0.5) / (len(keys) + 0.5))
+        docs.append(keys)
+        scores.append(idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * lengths / avg_length)))
+    unique, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+    totals = np.bincount(inverse, weights=np.concatenate(scores))
+    return [(int(unique[i]), float(totals[i])) for i in np.argsort(-totals, kind="stable")[:k]]
+
+class BM25Index:
+    """In-process inverted index with BM25 scoring, for exact-token matches (codenames like "ASL", "T5")."""
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.Lock()  # its own, so lexical searches do not hold up the vector index
+        self.postings = {}    # term -> {doc id: term frequency}
+        self.doc_lengths = {}  # doc id -> number of terms
+        self.total_length = 0
+        self.owned = None  # terms whose postings were copied since the last snapshot(); None: no snapshot shares them
+
+    @staticmethod
+    def tokenize(text):
+        return re.findall(r"[a-z0-9]+", text.lower())
+
+    @classmethod
+    def query_terms(cls, query):
+        return set(cls.tokenize(query)) - BM25_STOPWORDS
+
+    def add(self, doc_id, text):
+        terms = self.tokenize(text)
+        if not terms:
+            return
+        with self.lock:
+            self.doc_lengths[doc_id] = len(terms)
+            self.total_length += len(terms)
+            for term in terms:
+                postings = self._own(term)
+                postings[doc_id] = postings.get(doc_id, 0) + 1
+
+    def remove(self, doc_id, text):
+        with self.lock:
+            if doc_id not in self.doc_lengths:
+                return
+            self.total_length -= self.doc_lengths.pop(doc_id)
+            for term in set(self.tokenize(text)):
+                if term in self.postings:
+                    postings = self._own(term)
+                    postings.pop(doc_id, None)
+                    if not postings:
+                        del self.postings[term]
+
+    def _own(self, term):
+        """Postings of `term` that are safe to change: copied on their first change after a snapshot()."""
+        postings = self.postings.get(term)
+        if postings is None:
+            postings = self.postings[term] = {}
+        elif self.owned is not None and term not in self.owned:
+            postings = self.postings[term] = dict(postings)
+        if self.owned is not None:
+            self.owned.add(term)
+        return postings
+
+    def snapshot(self):
+        """
+        (postings, doc lengths, total length) as of now, without copying every posting list: the snapshot shares
+        them, and add()/remove() copy a term's postings before changing them (copy-on-write).
+        """
+        with self.lock:
+            self.owned = set()
+            return dict(self.postings), dict(self.doc_lengths), self.total_length
+
+    def __len__(self):
+        return len(self.postings)
+
+    def search(self, query, k):
+        """Top-k (doc id, score) pairs for the query terms."""
+        postings = []
+        with self.lock:
+            n = len(self.doc_lengths)
+            if n == 0:
+                return []
+            avg_length = self.total_length / n
+            # Only the copy into arrays happens under the lock; scoring is vectorized outside it
+            for term in self.query_terms(query):
+                term_postings = self.postings.get(term)
+                if term_postings:
+                    count = len(term_postings)
+                    postings.append((np.fromiter(term_postings.keys(), dtype="int64", count=count),
+                                     np.fromiter(term_postings.values(), dtype="float64", count=count),
+                                     np.fromiter(map(self.doc_lengths.__getitem__, term_postings), dtype="float64", count=count)))
+        return bm25_rank(postings, n, avg_length, self.k1, self.b, k)
+
+# Reciprocal rank fusion constant: larger values flatten the difference between ranks
+RRF_K = int(os.environ.get('RRF_K', '60'))
+
+def rrf_fuse(rankings, k):
+    """Reciprocal rank fusion of several ranked id lists: the k best (id, score) pairs."""
+    fused = {}
+    for hits in rankings:
+        for rank, doc_id in enumerate(hits):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)[:k]
+
+# ---------------------- Abbreviations --------------------
+class AbbreviationMatcher:
+    """
+    Aho-Corasick automaton over the internal codenames in the Abbreviations collection, so every codename in a
+    text is found in a single pass. Rebuilt whenever the collection changes.
+    """
+
+    def __init__(self, load_abbreviations=None):
+        self.load_abbreviations = load_abbreviations  # callable returning the current Abbreviations documents
+        self.lock = threading.Lock()
+        self.automaton = None  # (goto, fail, output) built from the current terms
+        self.explanations = {}
+
+    def build(self, abbreviations):
+        explanations = {a["term"]: a.get("explanation", "") for a in abbreviations if a.get("term")}
+        goto, fail, output = [{}], [0], [[]]
+        for term in explanations:
+            node = 0
+            for ch in term:
+                if ch not in goto[node]:
+                    goto.append({})
+                    fail.append(0)
+                    output.append([])
+                    goto[node][ch] = len(goto) - 1
+                node = goto[node][ch]
+            output[node].append(term)
+        # Breadth-first failure links
+        pending = list(goto[0].values())
+        while pending:
+            node = pending.pop(0)
+            for ch, child in goto[node].items():
+                pending.append(child)
+                state = fail[node]
+                while state and ch not in goto[state]:
+                    state = fail[state]
+                if node:
+                    fail[child] = goto[state].get(ch, 0)
+                output[child] = output[child] + output[fail[child]]
+        with self.lock:
+            self.automaton = (goto, fail, output)
+            self.explanations = explanations
+
+    def ensure_built(self):
+        if self.automaton is None:
+            self.build(self.load_abbreviations() if self.load_abbreviations else [])
+
+    def on_corpus_change(self, collection_name, upserted, deleted_ids):
+        if collection_name == "Abbreviations" and self.automaton is not None:
+            self.build(self.load_abbreviations() if self.load_abbreviations else [])
+
+    def find(self, text):
+        """Non-overlapping (start, end, term) matches on word boundaries, longest match first."""
+        self.ensure_built()
+        goto, fail, output = self.automaton
+        matches, node = [], 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for term in output[node]:
+                start = i - len(term) + 1
+                before = text[start - 1] if start > 0 else " "
+                after = text[i + 1] if i + 1 < len(text) else " "
+                if not before.isalnum() and not after.isalnum():
+                    matches.append((start, i + 1, term))
+        matches.sort(key=lambda m: (m[0], -(m[1] - m[0])))
+        chosen, last_end = [], 0
+        for start, end, term in matches:
+            if start >= last_end:
+                chosen.append((start, end, term))
+                last_end = end
+        return chosen
+
+    def annotate(self, text):
+        """Spell out the first occurrence of each codename, e.g. "ASL" -> "ASL (Age-sensitive logic)"."""
+        if not text:
+            return text
+        parts, last, seen = [], 0, set()
+        for start, end, term in self.find(text):
+            if term in seen or not self.explanations.get(term):
+                continue
+            seen.add(term)
+            parts.append(text[last:end])
+            parts.append(f" ({self.explanations[term]})")
+            last = end
+        parts.append(text[last:])
+        return "".join(parts)
+
+# ---------------------- Response Cache -------------------
+class ResponseCache:
+    """
+    LRU/TTL cache of generated answers, looked up by query-embedding similarity within a fingerprint of
+    (user, context). Prompts carry the user's own chat history, so answers are never shared between users.
+    """
+
+    def __init__(self, max_entries, ttl, threshold):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # entry id -> (created_at, fingerprint, unit query vector, answer)
+        self.by_fingerprint = {}      # context fingerprint -> {entry ids}
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    @staticmethod
+    def fingerprint(user_id, context):
+        return hashlib.sha256(f"{user_id}\n{context}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype="float32").reshape(-1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _evict(self, entry_id):
+        _, fingerprint, _, _ = self.entries.pop(entry_id)
+        ids = self.by_fingerprint.get(fingerprint)
+        ids.discard(entry_id)
+        if not ids:
+            del self.by_fingerprint[fingerprint]
+
+    def get(self, user_id, embedding, context):
+        fingerprint = self.fingerprint(user_id, context)
+        now = time.time()
+        with self.lock:
+            candidates = []
+            for entry_id in list(self.by_fingerprint.get(fingerprint, ())):
+                if now - self.entries[entry_id][0] >= self.ttl:
+                    self._evict(entry_id)
+                else:
+                    candidates.append(entry_id)
+            if candidates:
+                similarities = np.vstack([self.entries[i][2] for i in candidates]) @ self._unit(embedding)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self.entries.move_to_end(candidates[best])
+                    self.hits += 1
+                    return self.entries[candidates[best]][3]
+            self.misses += 1
+            return None
+
+    def put(self, user_id, embedding, context, answer):
+        fingerprint = self.fingerprint(user_id, context)
+        vector = self._unit(embedding)
+        with self.lock:
+            # A fresh answer (e.g. after no_cache=1) replaces the entries get() would otherwise still return
+            for entry_id in list(self.by_fingerprint.get(fingerprint, ())):
+                if float(self.entries[entry_id][2] @ vector) >= self.threshold:
+                    self._evict(entry_id)
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = (time.time(), fingerprint, vector, answer)
+            self.by_fingerprint.setdefault(fingerprint, set()).add(entry_id)
+            while len(self.entries) > self.max_entries:
+                self._evict(next(iter(self.entries)))
+
+    def bypass(self):
+        with self.lock:
+            self.bypassed += 1
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "bypassed": self.bypassed,
+                    "hit_rate": self.hits / total if total else 0.0, "size": len(self.entries)}
+
+# ---------------------- Section Structuring --------------
+class StreamingSectionParser:
+    """Pulls complete {"title", "content"} objects out of a JSON array while it is still being streamed."""
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = -1  # -1 until the opening "[" has been seen
+        self.decoder = json.JSONDecoder()
+        self.skipped = 0  # malformed objects passed over by finish()
+
+    def feed(self, text):
+        self.buffer += text
+        if self.pos < 0:
+            start = self.buffer.find("[")
+            if start < 0:
+                return []
+            self.pos = start + 1
+        elif "}" not in text:
+            return []  # an object can only have completed if this piece closed one
+        return self._drain()
+
+    def finish(self):
+        """At the end of the stream, skip past malformed objects (to the next "{") and return the objects after them."""
+        found = self._drain() if self.pos >= 0 else []
+        while 0 <= self.pos < len(self.buffer) and self.buffer[self.pos] == "{":
+            self.skipped += 1
+            next_start = self.buffer.find("{", self.pos + 1)
+            if next_start < 0:
+                self.pos = len(self.buffer)
+                break
+            self.pos = next_start
+            found.extend(self._drain())
+        return found
+
+    def _drain(self):
+        found = []
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n,":
+                self.pos += 1
+            if self.pos >= len(self.buffer) or self.buffer[self.pos] != "{":
+                break
+            try:
+                obj, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                break  # object not complete yet
+            if isinstance(obj, dict):
+                found.append(obj)
+            self.pos = end
+        return found
+
+# "§ 1234", "Section 5(a)", "Sec. 12" at the start of a line...
+STATUTE_PATTERN = re.compile(r"^[ \t]*((?:§+\s*|(?:Section|Sec\.)\s+)\d+[\w.\-]*(?:\(\w+\))*)", re.MULTILINE)
+# ...unless it is a sentence about that section ("Section 5 of this Act is reserved.")
+CROSS_REFERENCE_PATTERN = re.compile(r"[ \t]+(?:of|to|in|and|or|is|are|shall|does)\b")
+
+def statute_title(text, pos):
+    line = text[pos:pos + 150].split("\n")[0]
+    parts = re.split(r"(?<=\.)\s", line, maxsplit=2)
+    # "Section 5(a). Definitions. In this act ..." -> "Section 5(a). Definitions."
+    return (" ".join(parts[:2]) if len(parts) > 2 else line)[:100].strip()
+
+def split_sections_by_rules(text, headings=None):
+    """
+    Split text into sections at known headings (from the scraper) and statute numbering.
+    Heading text becomes the section title; statute-numbered sections keep their numbering in the content.
+    Sections without either get title None.
+    """
+    boundaries = []  # (position, title, content start)
+    cursor = 0
+    for heading in headings or []:
+        words = heading.split()
+        if not words:
+            continue
+        # A heading is a whole line of its own, never the same words inside a sentence
+        match = re.compile(r"^[ \t]*" + r"\s+".join(map(re.escape, words)) + r"[ \t]*$", re.MULTILINE).search(text, cursor)
+        if match:
+            boundaries.append((match.start(), heading.strip(), match.end()))
+            cursor = match.end()
+    heading_spans = [(start, end) for start, _, end in boundaries]
+    for match in STATUTE_PATTERN.finditer(text):
+        pos = match.start(1)
+        if CROSS_REFERENCE_PATTERN.match(text, match.end(1)):
+            continue
+        if not any(start <= pos < end for start, end in heading_spans):
+            boundaries.append((pos, statute_title(text, pos), pos))
+    boundaries.sort()
+
+    sections = []
+    preamble = text[:boundaries[0][0] if boundaries else len(text)].strip()
+    if preamble:
+        sections.append({"title": None, "content": preamble})
+    for i, (pos, title, content_start) in enumerate(boundaries):
+        end = boundaries[i + 1][0] if i + 1 < len(boundaries) else len(text)
+        content = text[content_start:end].strip()
+        if content:
+            sections.append({"title": title, "content": content})
+    return sections
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def section_hash(section):
+    return text_hash(f"{section.get('title', '')}\n{section.get('content', '')}")
+
+def summarize_section_changes(previous_sections, sections):
+    """
+    Stamp section_hash on the new sections and count them against the previous version: unchanged (same hash),
+    changed (a previous title with new text), new, and removed (previous titles that no longer appear).
+    """
+    previous = {section.get("section_hash") or section_hash(section): section for section in previous_sections}
+    previous_titles = {section.get("title") for section in previous_sections}
+    summary = {"sections_unchanged": 0, "sections_changed": 0, "sections_new": 0}
+    for section in sections:
+        section["section_hash"] = section_hash(section)
+        if section["section_hash"] in previous:
+            summary["sections_unchanged"] += 1
+        else:
+            summary["sections_changed" if section.get("title") in previous_titles else "sections_new"] += 1
+    titles = {section.get("title") for section in sections}
+    summary["sections_removed"] = sum(1 for section in previous_sections if section.get("title") not in titles)
+    return summary
@@ -367,14 +367,58 @@ document.getElementById('chatForm').addEventListener('submit', async (e) => {
   }
 
   const token = document.querySelector('meta[name="csrf-token"]').content;
-  const res = await fetch('/chat/send', { method: 'POST', body: fd , headers: { 'X-CSRFToken': token }});
-  if (res.ok) {
-    const data = await res.json();
-    data.messages.forEach(m => appendMessage(m.role, m.text, m.files));
-    const container = document.getElementById('chatWindow');
-    container.scrollTop = container.scrollHeight;
-  } else {
+  const res = await fetch('/chat/stream', { method: 'POST', body: fd , headers: { 'X-CSRFToken': token }});
+  if (res.status === 429) {
+    alert('The assistant is busy, please retry in a few seconds.');
+    return;
+  }
+  if (!res.ok || !res.body) {
     alert('Error sending message.');
+    return;
+  }
+
+  // Read Server-Sent Events off the response body and render tokens as they arrive
+  const container = document.getElementById('chatWindow');
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  let botText = null;
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const frame = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      let event = 'message';
+      let data = '';
+      frame.split('\n').forEach(line => {
+        if (line.startsWith('event: ')) event = line.slice(7);
+        else if (line.startsWith('data: ')) data += line.slice(6);
+      });
+      if (!data) continue;
+      const payload = JSON.parse(data);
+
+      if (event === 'user') {
+        appendMessage(payload.role, payload.text, payload.files);
+      } else if (event === 'error') {
+        alert(payload.message || 'Error sending message.');
+      } else if (event === 'message') {
+        if (!botText) {
+          const wrap = document.createElement('div');
+          wrap.className = 'message bot-message';
+          botText = document.createElement('div');
+          wrap.appendChild(botText);
+          container.appendChild(wrap);
+        }
+        botText.innerText += payload.token;
+      }
+      container.scrollTop = container.scrollHeight;
+    }
   }
 });
 
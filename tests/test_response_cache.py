@@ -0,0 +1,33 @@
+from rag_helpers import ResponseCache
+
+
+def make_cache():
+    return ResponseCache(max_entries=10, ttl=3600, threshold=0.95)
+
+
+def test_refreshed_answer_replaces_the_cached_one():
+    cache = make_cache()
+    cache.put("u1", [1.0, 0.0], "context", "old answer")
+
+    # no_cache=1 skips get() and stores the regenerated answer
+    cache.put("u1", [1.0, 0.01], "context", "new answer")
+
+    assert cache.get("u1", [1.0, 0.0], "context") == "new answer"
+    assert cache.stats()["size"] == 1
+
+
+def test_dissimilar_questions_keep_their_own_answers():
+    cache = make_cache()
+    cache.put("u1", [1.0, 0.0], "context", "first")
+    cache.put("u1", [0.0, 1.0], "context", "second")
+
+    assert cache.get("u1", [1.0, 0.0], "context") == "first"
+    assert cache.get("u1", [0.0, 1.0], "context") == "second"
+
+
+def test_answers_are_not_shared_between_users_or_contexts():
+    cache = make_cache()
+    cache.put("u1", [1.0, 0.0], "context", "answer")
+
+    assert cache.get("u2", [1.0, 0.0], "context") is None
+    assert cache.get("u1", [1.0, 0.0], "other context") is None
@@ -0,0 +1,125 @@
+from rag_helpers import AbbreviationMatcher, BM25Index, RRF_K, estimate_tokens, rrf_fuse, split_into_passages
+
+
+def test_bm25_ranks_exact_token_matches_first():
+    index = BM25Index()
+    index.add(1, "ASL applies to all minors in the United States")
+    index.add(2, "Age verification for online platforms")
+    index.add(3, "ASL and T5 data are stored separately; ASL is reviewed yearly")
+
+    results = index.search("what is ASL", 10)
+
+    assert [doc_id for doc_id, _ in results] == [3, 1]
+    assert results[0][1] > results[1][1] > 0
+
+
+def test_bm25_ignores_stopwords_and_unknown_terms():
+    index = BM25Index()
+    index.add(1, "the rules of the state")
+
+    assert index.search("the of", 10) == []
+    assert index.search("unknownterm", 10) == []
+    assert BM25Index.query_terms("What is the ASL") == {"asl"}
+
+
+def test_bm25_remove_drops_document_and_empty_postings():
+    index = BM25Index()
+    index.add(1, "geofencing rules")
+    index.add(2, "parental consent rules")
+
+    index.remove(1, "geofencing rules")
+
+    assert [doc_id for doc_id, _ in index.search("geofencing rules", 10)] == [2]
+    assert "geofencing" not in index.postings
+    assert index.total_length == 3
+
+
+def test_bm25_snapshot_is_unaffected_by_later_changes():
+    index = BM25Index()
+    index.add(1, "geofencing rules")
+    index.add(2, "parental consent rules")
+
+    postings, doc_lengths, total_length = index.snapshot()
+    index.add(3, "new rules")
+    index.remove(1, "geofencing rules")
+
+    assert postings["rules"] == {1: 1, 2: 1}
+    assert postings["geofencing"] == {1: 1}
+    assert "new" not in postings
+    assert doc_lengths == {1: 2, 2: 3} and total_length == 5
+    assert index.postings["rules"] == {2: 1, 3: 1}
+
+
+def test_rrf_fuse_rewards_ids_found_by_both_rankings():
+    vector_hits = [10, 20, 30]
+    lexical_hits = [30, 40]
+
+    fused = rrf_fuse([vector_hits, lexical_hits], 2)
+
+    assert [doc_id for doc_id, _ in fused] == [30, 10]
+    assert fused[0][1] == 1.0 / (RRF_K + 3) + 1.0 / (RRF_K + 1)
+
+
+def test_rrf_fuse_keeps_k_best():
+    assert len(rrf_fuse([[1, 2, 3], [4, 5]], 2)) == 2
+    assert rrf_fuse([[], []], 5) == []
+
+
+def test_passages_respect_max_tokens_and_overlap():
+    sentences = [f"Sentence number {i} talks about the rule in some detail." for i in range(40)]
+
+    passages = split_into_passages(" ".join(sentences), max_tokens=64, overlap_tokens=16)
+
+    assert len(passages) > 1
+    assert all(estimate_tokens(p) <= 64 for p in passages)
+    # Each passage starts with the tail of the one before it
+    for previous, passage in zip(passages, passages[1:]):
+        assert previous.endswith(passage.split(". ")[0] + ".")
+
+
+def test_passages_hard_split_an_overlong_sentence():
+    passages = split_into_passages(" ".join(["word"] * 500), max_tokens=50, overlap_tokens=0)
+
+    assert len(passages) > 1
+    assert all(estimate_tokens(p) <= 50 for p in passages)
+    assert sum(len(p.split()) for p in passages) == 500
+
+
+def test_passages_hard_split_stays_within_max_tokens_for_mixed_word_lengths():
+    words = ["x" * 60] * 20 + ["law"] * 200
+
+    passages = split_into_passages(" ".join(words), max_tokens=50, overlap_tokens=0)
+
+    assert all(estimate_tokens(p) <= 50 for p in passages)
+    assert " ".join(passages).split() == words
+
+
+def test_passages_cut_a_word_longer_than_a_passage():
+    url = "https://example.com/" + "a" * 300
+
+    passages = split_into_passages(f"See {url} for details.", max_tokens=20, overlap_tokens=0)
+
+    assert all(estimate_tokens(p) <= 20 for p in passages)
+    assert "".join(passages).replace(" ", "") == f"See{url}fordetails."
+
+
+def make_matcher(terms):
+    matcher = AbbreviationMatcher()
+    matcher.build([{"term": term, "explanation": explanation} for term, explanation in terms.items()])
+    return matcher
+
+
+def test_abbreviation_find_matches_whole_words_longest_first():
+    matcher = make_matcher({"ASL": "Age-sensitive logic", "ASL-X": "Extended ASL", "T5": "Tier 5 data"})
+
+    text = "Use ASL-X and T5, not BASL or ASLs."
+
+    assert [term for _, _, term in matcher.find(text)] == ["ASL-X", "T5"]
+    start, end, _ = matcher.find(text)[0]
+    assert text[start:end] == "ASL-X"
+
+
+def test_abbreviation_annotate_spells_out_first_occurrence_only():
+    matcher = make_matcher({"ASL": "Age-sensitive logic"})
+
+    assert matcher.annotate("ASL gates ASL.") == "ASL (Age-sensitive logic) gates ASL."
@@ -0,0 +1,76 @@
+from rag_helpers import StreamingSectionParser, section_hash, split_sections_by_rules, summarize_section_changes
+
+
+def test_parser_returns_objects_as_they_complete():
+    parser = StreamingSectionParser()
+
+    assert parser.feed('Here you go: [{"title": "A", "con') == []
+    assert parser.feed('tent": "first"}, {"title": "B",') == [{"title": "A", "content": "first"}]
+    assert parser.feed(' "content": "x}y"}]') == [{"title": "B", "content": "x}y"}]
+    assert parser.finish() == []
+    assert parser.skipped == 0
+
+
+def test_parser_finish_skips_malformed_objects():
+    parser = StreamingSectionParser()
+
+    found = parser.feed('[{"title": "A", "content": "a"}, {"title": "B" "content": "b"}, {"title": "C", "content": "c"}]')
+    found += parser.finish()
+
+    assert [section["title"] for section in found] == ["A", "C"]
+    assert parser.skipped == 1
+
+
+def test_rules_split_on_statute_numbering_but_not_cross_references():
+    text = ("Preamble text.\n"
+            "§ 1. Definitions. In this act words mean things.\n"
+            "Section 2(a). Scope. This act applies to platforms.\n"
+            "Section 1 of this act is reserved for definitions.\n")
+
+    sections = split_sections_by_rules(text)
+
+    assert [section["title"] for section in sections] == [None, "§ 1. Definitions.", "Section 2(a). Scope."]
+    assert sections[0]["content"] == "Preamble text."
+    assert sections[2]["content"].endswith("reserved for definitions.")
+
+
+def test_rules_split_on_headings_only_as_whole_lines():
+    text = ("Intro paragraph about the scope of the law.\n"
+            "Scope\n"
+            "Applies to online services.\n"
+            "Penalties\n"
+            "Fines of up to $5,000.\n")
+
+    sections = split_sections_by_rules(text, ["Scope", "Penalties"])
+
+    assert [(section["title"], section["content"]) for section in sections] == [
+        (None, "Intro paragraph about the scope of the law."),
+        ("Scope", "Applies to online services."),
+        ("Penalties", "Fines of up to $5,000."),
+    ]
+
+
+def test_section_summary_counts_each_section_once():
+    previous = [
+        {"title": "Scope", "content": "Applies to platforms."},
+        {"title": "Penalties", "content": "Fines of up to $1,000."},
+        {"title": "Sunset", "content": "Expires in 2030."},
+    ]
+    for section in previous:
+        section["section_hash"] = section_hash(section)
+    sections = [
+        {"title": "Scope", "content": "Applies to platforms."},
+        {"title": "Penalties", "content": "Fines of up to $5,000."},
+        {"title": "Reporting", "content": "Annual reports are due."},
+    ]
+
+    summary = summarize_section_changes(previous, sections)
+
+    assert summary == {"sections_unchanged": 1, "sections_changed": 1, "sections_new": 1, "sections_removed": 1}
+    assert all(section["section_hash"] == section_hash(section) for section in sections)
+
+
+def test_section_summary_without_previous_version():
+    summary = summarize_section_changes([], [{"title": None, "content": "text"}])
+
+    assert summary == {"sections_unchanged": 0, "sections_changed": 0, "sections_new": 1, "sections_removed": 0}